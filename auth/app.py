@@ -13,13 +13,21 @@
 #   limitations under the License.
 
 import os
+import signal
+import threading
+from argparse import ArgumentParser
+from time import perf_counter
 
 import yaml
 from flask import Flask, current_app
-from flask_session import Session
 
 from auth.config import Config
-from auth.utils import config
+from auth.mappers import load_mappers
+from auth.utils import config, metrics
+from auth.utils.decision_cache import decision_cache
+from auth.utils.jsonpath import compile_mappers, session_claims
+from auth.utils.realms import DEFAULT_REALM, build_realms
+from auth.utils.session import CookieSessionInterface, RedisSessionInterface
 
 
 def read_config():  # Reading the config file
@@ -31,43 +39,178 @@ def read_config():  # Reading the config file
         settings = yaml.load(os.path.expandvars(settings_data), Loader=yaml.SafeLoader)
         settings = config.config_substitution(settings, config.vault_secrets(settings))
 
-    current_app.config["global"] = settings["global"]
-    current_app.config["endpoints"] = settings["endpoints"]
-    current_app.config["auth"] = settings["auth"]
-    current_app.config["mappers"] = settings["mappers"]
-    current_app.config["keys"] = []
+    # Everything is prepared first and swapped in with one update, requests never see a half-read config
+    snapshot = {
+        "global": settings["global"],
+        "endpoints": settings["endpoints"],
+        "auth": settings["auth"],
+        "mappers": settings["mappers"],
+        "mapper_plans": compile_mappers(settings["mappers"]),
+        "session_claims": session_claims(settings["mappers"], settings["global"].get("session_claims", ())),
+        "keys": [],
+    }
     for key in Config.AUTH_PROXIES:
         if key not in settings:
             continue
-        current_app.config[key] = settings[key]
+        snapshot[key] = settings[key]
+    if "oidc" in settings:
+        snapshot["oidc_realms"], snapshot["oidc_issuers"] = build_realms(settings["oidc"])
+    # Signing and encryption keys must be shared by all replicas, allow them in settings (and so in Vault)
+    if settings["global"].get("secret_key"):
+        snapshot["SECRET_KEY"] = settings["global"]["secret_key"]
+    if settings["global"].get("session_cookie_encryption_key"):
+        snapshot["SESSION_COOKIE_ENCRYPTION_KEY"] = settings["global"]["session_cookie_encryption_key"]
+    current_app.config.update(snapshot)
+    if current_app.secret_key == Config.DEFAULT_SECRET_KEY:
+        current_app.logger.warning("Using built-in SECRET_KEY, set SECRET_KEY or global.secret_key")
+
+
+def reload_config(app):
+    """ Re-read settings and Vault secrets, keeping warm caches and pools whose settings did not change """
+    with app.extensions["reload_lock"], app.app_context():
+        previous_oidc = current_app.config.get("oidc")
+        read_config()
+        decision_cache.clear()  # Mapper plans may have changed
+        if "oidc" in current_app.config:
+            if "oidc" not in current_app.blueprints:
+                current_app.logger.warning("oidc section was added, restart is needed to enable it")
+            else:
+                seed_oidc(previous_oidc)
+        current_app.logger.info("Configuration reloaded")
+
+
+def _reload_on_signal(app, requested):
+    while True:
+        requested.wait()
+        requested.clear()
+        try:
+            reload_config(app)
+        except:  # pylint: disable=W0702
+            app.logger.exception("Configuration reload failed, keeping previous configuration")
+
+
+def seed_reload():
+    app = current_app._get_current_object()  # pylint: disable=W0212
+    app.extensions["reload_config"] = reload_config
+    app.extensions["reload_lock"] = threading.Lock()  # Created in the worker, after gevent has patched threading
+    reload_settings = current_app.config["global"].get("config_reload", dict())
+    watcher = config.ConfigWatcher(
+        Config.CONFIG_FILENAME, lambda: reload_config(app), app.logger,
+        watch_interval=reload_settings.get("watch_interval", 0),
+        vault_interval=reload_settings.get("vault_interval", 0),
+    )
+    if watcher.enabled:
+        watcher.start()
+    if threading.current_thread() is threading.main_thread() and hasattr(signal, "SIGHUP"):
+        requested = threading.Event()
+        threading.Thread(target=_reload_on_signal, args=(app, requested), name="config-reload", daemon=True).start()
+        # Handler only sets the event: under gevent it runs in the event loop, where it must not block
+        signal.signal(signal.SIGHUP, lambda *args: requested.set())
+
+
+def seed_sessions():
+    if current_app.config["SESSION_TYPE"] == "cookie":
+        current_app.session_interface = CookieSessionInterface()
+    else:
+        root = current_app.config["endpoints"]["root"]
+        current_app.session_interface = RedisSessionInterface(
+            current_app.config["SESSION_REDIS"], current_app.config["SESSION_REDIS_REPLICA"],
+            key_prefix=current_app.config.get("SESSION_KEY_PREFIX", "session:"),
+            use_signer=current_app.config.get("SESSION_USE_SIGNER", False),
+            permanent=current_app.config.get("SESSION_PERMANENT", True),
+            replica_paths=(f"{root}/auth", f"{root}/me"),
+            stateless_paths=(f"{root}/auth", f"{root}/auth/batch"),
+        )
+
+
+def seed_mappers():
+    current_app.config["mapper_registry"] = load_mappers(current_app.logger)
+
+
+def _warm_up_oidc(app, issuer, ttl, client_secret):
+    from auth.drivers.oidc import provider_cache
+    try:  # Requests fetch discovery lazily if the issuer is not reachable yet, /ready reports when it is loaded
+        provider_cache.load(issuer, ttl, client_secret)
+    except:  # pylint: disable=W0702
+        app.logger.warning("OIDC provider configuration is not available")
+
+
+def seed_oidc(previous=None):
+    """ HTTP pool and discovery warm-up per realm, kept as they are for realms whose settings did not change """
+    from auth.drivers.oidc import http, http_sessions
+    from auth.utils.http import HttpSession
+    previous_realms = build_realms(previous)[0] if previous else dict()
+    provider_keys = ("issuer", "provider_config_ttl")
+    for name, settings in current_app.config["oidc_realms"].items():
+        before = previous_realms.get(name, dict())
+        issuer = settings["issuer"].rstrip("/")
+        if issuer not in http_sessions:
+            http_sessions[issuer] = http if name == DEFAULT_REALM else HttpSession()
+            before = dict()
+        if before.get("http") != settings.get("http") or not before:
+            http_sessions[issuer].configure(settings.get("http"))
+        if [before.get(key) for key in provider_keys] == [settings.get(key) for key in provider_keys] and \
+                before.get("registration", dict()).get("client_secret") == \
+                settings["registration"].get("client_secret"):
+            continue
+        threading.Thread(
+            target=_warm_up_oidc, daemon=True, name=f"oidc-warm-up-{name}",
+            args=(current_app._get_current_object(), settings["issuer"],  # pylint: disable=W0212
+                  settings.get("provider_config_ttl", 3600), settings["registration"].get("client_secret")),
+        ).start()
 
 
 def seed_endpoints():
     from auth.drivers.root import bp
     current_app.register_blueprint(bp, url_prefix=current_app.config["endpoints"]["root"])
     if "oidc" in current_app.config:
-        from auth.drivers.oidc import bp
+        from auth.drivers.oidc import bp, _delete_refresh_token
+        from auth.utils.revocation_queue import revocation_queue
         current_app.register_blueprint(bp, url_prefix=current_app.config["endpoints"]["oidc"])
+        seed_oidc()
+        revocation_queue.start(
+            current_app._get_current_object(), _delete_refresh_token,  # pylint: disable=W0212
+            workers=Config.REVOCATION_WORKERS, poll_interval=Config.REVOCATION_POLL_INTERVAL,
+        )
 
 
 def create_app():
-    app_session = Session()
+    started = perf_counter()
     app = Flask(__name__)
 
     # Application Configuration
     app.config.from_object(Config)
 
-    # Initialize Plugins
-    app_session.init_app(app)
-
     with app.app_context():
         read_config()
+        seed_sessions()
+        seed_mappers()
         seed_endpoints()
+        seed_reload()
+    startup_seconds = perf_counter() - started
+    metrics.STARTUP_SECONDS.set(startup_seconds)
+    if startup_seconds > Config.STARTUP_BUDGET:
+        app.logger.warning(f"Startup took {startup_seconds:.3f}s, over {Config.STARTUP_BUDGET}s budget")
     return app
 
 
+def parse_args(args=None):
+    parser = ArgumentParser(description="Auth middleware")
+    parser.add_argument("--server", choices=("gevent", "dev"), default=Config.APP_SERVER,
+                        help="gevent: production server, dev: Flask development server with debugger")
+    parser.add_argument("--workers", type=int, default=Config.APP_WORKERS, help="Number of worker processes")
+    parser.add_argument("--concurrency", type=int, default=Config.APP_CONCURRENCY,
+                        help="Concurrent requests handled by each worker")
+    return parser.parse_args(args)
+
+
 def main():
-    create_app().run(host=Config.APP_HOST, port=Config.APP_PORT, debug=True)
+    args = parse_args()
+    if args.server == "dev":
+        create_app().run(host=Config.APP_HOST, port=Config.APP_PORT, debug=True)
+        return
+    from auth.server import serve
+    serve(Config.APP_HOST, Config.APP_PORT, args.workers, args.concurrency)
 
 
 if __name__ == "__main__":
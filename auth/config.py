@@ -15,6 +15,20 @@
 from os import environ
 
 import redis
+from redis.sentinel import Sentinel
+
+
+def sentinel_pools(sentinels, service_name, sentinel_password=None, **connection_kwargs):
+    """ Primary and replica pools for a Sentinel-managed service, both follow failovers """
+    sentinel = Sentinel(
+        [(host, int(port)) for host, _, port in (item.strip().rpartition(":") for item in sentinels.split(","))],
+        sentinel_kwargs={"password": sentinel_password, "socket_timeout": connection_kwargs.get("socket_timeout")},
+        **connection_kwargs,
+    )
+    return (
+        sentinel.master_for(service_name).connection_pool,
+        sentinel.slave_for(service_name).connection_pool,
+    )
 
 
 class Config:
@@ -23,9 +37,15 @@ class Config:
     # General Config
     APP_HOST = "0.0.0.0"
     APP_PORT = "80"
+    APP_SERVER = environ.get("APP_SERVER", "gevent")
+    APP_WORKERS = int(environ.get("APP_WORKERS", 2))
+    APP_CONCURRENCY = int(environ.get("APP_CONCURRENCY", 1000))
     CONFIG_FILENAME = environ.get("CONFIG_FILENAME", None)
+    STARTUP_BUDGET = float(environ.get("STARTUP_BUDGET", 1.0))  # seconds, slower startup is logged
+    SERVER_TIMING = environ.get("SERVER_TIMING", "false").lower() in ("1", "true", "yes")
     AUTH_PROXIES = ("oidc", "root")
-    SECRET_KEY = b"_5#y2L\"F4Q8z\n\xec]/"
+    DEFAULT_SECRET_KEY = b"_5#y2L\"F4Q8z\n\xec]/"
+    SECRET_KEY = environ.get("SECRET_KEY", DEFAULT_SECRET_KEY)
     SESSION_COOKIE_NAME = "auth"
 
     # Redis client
@@ -35,8 +55,100 @@ class Config:
     REDIS_PORT = int(environ.get("REDIS_PORT", 6379))
     REDIS_DB = int(environ.get("REDIS_DB", 3))
 
-    # Flask-Session
-    SESSION_TYPE = environ.get("SESSION_TYPE", "redis")
-    SESSION_REDIS = redis.from_url(
-        environ.get("SESSION_REDIS", f"redis://{REDIS_USER}:{REDIS_PASSWORD}@{REDIS_HOST}:{REDIS_PORT}/{REDIS_DB}")
+    # Process-local token cache in front of Redis
+    LOCAL_CACHE_SIZE = int(environ.get("LOCAL_CACHE_SIZE", 10000))
+    LOCAL_CACHE_TTL = int(environ.get("LOCAL_CACHE_TTL", 30))
+
+    # Per-login memo of mapper decisions (group membership and scope headers)
+    DECISION_CACHE_SIZE = int(environ.get("DECISION_CACHE_SIZE", 10000))
+    DECISION_CACHE_TTL = int(environ.get("DECISION_CACHE_TTL", 300))
+
+    # Cross-worker lock around upstream credential validation
+    AUTH_LOCK_TIMEOUT = float(environ.get("AUTH_LOCK_TIMEOUT", 10))
+    AUTH_LOCK_WAIT = float(environ.get("AUTH_LOCK_WAIT", 10))
+
+    # Cached Basic/Bearer identities: TTL per auth type, sliding expiry and background
+    # revalidation once less than TOKEN_REFRESH_AHEAD of the TTL is left (0 disables)
+    TOKEN_TTL_BASIC = int(environ.get("TOKEN_TTL_BASIC", 60 * 10))
+    TOKEN_TTL_BEARER = int(environ.get("TOKEN_TTL_BEARER", 60 * 10))
+    TOKEN_SLIDING_EXPIRY = environ.get("TOKEN_SLIDING_EXPIRY", "false").lower() in ("1", "true", "yes")
+    TOKEN_REFRESH_AHEAD = float(environ.get("TOKEN_REFRESH_AHEAD", 0.2))
+    TOKEN_REFRESH_WORKERS = int(environ.get("TOKEN_REFRESH_WORKERS", 4))
+
+    # POST /auth/batch: headers per request and concurrent upstream validations per worker.
+    BATCH_AUTH_MAX_SIZE = int(environ.get("BATCH_AUTH_MAX_SIZE", 100))
+    BATCH_AUTH_WORKERS = int(environ.get("BATCH_AUTH_WORKERS", 8))
+
+    # Background refresh token revocation: worker threads per process, batch size, claim lease,
+    # attempts before dead-lettering, base retry backoff (seconds, doubled per attempt), poll interval
+    # and tokens queued at most
+    REVOCATION_WORKERS = int(environ.get("REVOCATION_WORKERS", 2))
+    REVOCATION_BATCH_SIZE = int(environ.get("REVOCATION_BATCH_SIZE", 20))
+    REVOCATION_LEASE = float(environ.get("REVOCATION_LEASE", 60))
+    REVOCATION_MAX_ATTEMPTS = int(environ.get("REVOCATION_MAX_ATTEMPTS", 5))
+    REVOCATION_BACKOFF = float(environ.get("REVOCATION_BACKOFF", 1))
+    REVOCATION_POLL_INTERVAL = float(environ.get("REVOCATION_POLL_INTERVAL", 1))
+    REVOCATION_MAX_PENDING = int(environ.get("REVOCATION_MAX_PENDING", 100000))
+
+    # Proxies in front that append to X-Forwarded-For, the client is the address the outermost one saw
+    TRUSTED_PROXIES = int(environ.get("TRUSTED_PROXIES", 1))
+
+    # Refused credentials: negative cache and token bucket limits (rate per second, burst), rate 0 disables
+    NEGATIVE_CACHE_TTL = int(environ.get("NEGATIVE_CACHE_TTL", 30))
+    RATE_LIMIT_CREDENTIAL = (
+        float(environ.get("RATE_LIMIT_CREDENTIAL_RATE", 1)), float(environ.get("RATE_LIMIT_CREDENTIAL_BURST", 5))
     )
+    RATE_LIMIT_CLIENT = (
+        float(environ.get("RATE_LIMIT_CLIENT_RATE", 10)), float(environ.get("RATE_LIMIT_CLIENT_BURST", 50))
+    )
+
+    # Cached identities and Redis sessions are msgpack-encoded, zlib-compressed from this size in bytes.
+    # Off by default: every /auth call decodes the session, decompressing costs more than it saves in Redis
+    SERIALIZER_COMPRESS_MIN_SIZE = int(environ.get("SERIALIZER_COMPRESS_MIN_SIZE", 0))
+
+    # Shared Redis connection pools, used by token cache and Flask-Session. Writes go to REDIS_POOL,
+    # read-mostly lookups to REDIS_REPLICA_POOL: Sentinel replicas with REDIS_SENTINELS=host:port,...
+    # and REDIS_READ_FROM_REPLICAS enabled, otherwise the same pool
+    REDIS_SENTINELS = environ.get("REDIS_SENTINELS", "")
+    REDIS_SENTINEL_SERVICE = environ.get("REDIS_SENTINEL_SERVICE", "mymaster")
+    REDIS_SENTINEL_PASSWORD = environ.get("REDIS_SENTINEL_PASSWORD", None)
+    REDIS_READ_FROM_REPLICAS = environ.get("REDIS_READ_FROM_REPLICAS", "true").lower() in ("1", "true", "yes")
+    REDIS_URL = environ.get(
+        "SESSION_REDIS", f"redis://{REDIS_USER}:{REDIS_PASSWORD}@{REDIS_HOST}:{REDIS_PORT}/{REDIS_DB}"
+    )
+    REDIS_MAX_CONNECTIONS = int(environ.get("REDIS_MAX_CONNECTIONS", 50))
+    REDIS_SOCKET_TIMEOUT = float(environ.get("REDIS_SOCKET_TIMEOUT", 5))
+    REDIS_SOCKET_CONNECT_TIMEOUT = float(environ.get("REDIS_SOCKET_CONNECT_TIMEOUT", 5))
+    REDIS_HEALTH_CHECK_INTERVAL = int(environ.get("REDIS_HEALTH_CHECK_INTERVAL", 30))
+    if REDIS_SENTINELS:
+        REDIS_POOL, REDIS_REPLICA_POOL = sentinel_pools(
+            REDIS_SENTINELS, REDIS_SENTINEL_SERVICE,
+            sentinel_password=REDIS_SENTINEL_PASSWORD,
+            password=REDIS_PASSWORD or None,
+            db=REDIS_DB,
+            username=REDIS_USER or None,
+            max_connections=REDIS_MAX_CONNECTIONS,
+            socket_timeout=REDIS_SOCKET_TIMEOUT,
+            socket_connect_timeout=REDIS_SOCKET_CONNECT_TIMEOUT,
+            socket_keepalive=True,
+            health_check_interval=REDIS_HEALTH_CHECK_INTERVAL,
+        )
+        if not REDIS_READ_FROM_REPLICAS:
+            REDIS_REPLICA_POOL = REDIS_POOL
+    else:
+        REDIS_POOL = redis.BlockingConnectionPool.from_url(
+            REDIS_URL,
+            max_connections=REDIS_MAX_CONNECTIONS,
+            timeout=REDIS_SOCKET_CONNECT_TIMEOUT,
+            socket_timeout=REDIS_SOCKET_TIMEOUT,
+            socket_connect_timeout=REDIS_SOCKET_CONNECT_TIMEOUT,
+            socket_keepalive=True,
+            health_check_interval=REDIS_HEALTH_CHECK_INTERVAL,
+        )
+        REDIS_REPLICA_POOL = REDIS_POOL
+
+    # Flask-Session, or stateless signed cookie sessions with SESSION_TYPE=cookie
+    SESSION_TYPE = environ.get("SESSION_TYPE", "redis")
+    SESSION_COOKIE_ENCRYPTION_KEY = environ.get("SESSION_COOKIE_ENCRYPTION_KEY", None)
+    SESSION_REDIS = redis.Redis(connection_pool=REDIS_POOL)
+    SESSION_REDIS_REPLICA = redis.Redis(connection_pool=REDIS_REPLICA_POOL)
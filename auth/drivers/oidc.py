@@ -12,35 +12,195 @@
 #   See the License for the specific language governing permissions and
 #   limitations under the License.
 
-import base64
 from json import dumps, loads
+from threading import Lock, Thread
+from time import monotonic, time
+from typing import Optional
+from urllib.parse import urlsplit
 
-from flask import session, redirect, request, Blueprint, g, current_app
+from flask import session, redirect, request, make_response, Blueprint, g, current_app
+from jwkest.jws import JWS
 from oic import rndstr
+from oic.exception import MissingParameter, ParameterError
 from oic.oauth2.exception import GrantError
 from oic.oic import Client
 from oic.oic.message import ProviderConfigurationResponse, RegistrationResponse, AuthorizationResponse
 from oic.utils.authn.client import CLIENT_AUTHN_METHOD
-from requests import get, post
+from oic.utils.keyio import KeyBundle, KeyJar
 
-from auth.utils.session import clear_session
+from auth.config import Config
+from auth.drivers.root import _client_ip
+from auth.utils.http import HttpSession
+from auth.utils.redis_client import RedisClient
+from auth.utils.revocation_queue import revocation_queue
+from auth.utils.metrics import timed, timer
+from auth.utils.realms import DEFAULT_REALM, decode_id_token, realm_for_token, realm_settings
+from auth.utils.session import clear_session, load_location
+from auth.utils.single_flight import SingleFlight
 
 bp = Blueprint("oidc", __name__)
+DEFAULT_PORTS = {"http": "80", "https": "443"}
+http = HttpSession()  # Settings are applied from the oidc "http" section at startup
+http_sessions = dict()  # {issuer: HttpSession}, one pool per realm, default realm uses ``http``
+
+
+def http_for(issuer):
+    return http_sessions.get(issuer.rstrip("/"), http)
+
+
+class ProviderCache:
+    """
+    Discovery documents and key jars shared by all requests, refreshed ahead of expiry.
+
+    Provider keys are fetched with discovery and replaced as a whole, shared key bundles never fetch
+    on their own, so a failing JWKS endpoint can not empty them under running requests.
+    """
+
+    REFRESH_AHEAD = 0.8
+
+    def __init__(self):
+        self._lock = Lock()
+        self._entries = {}
+        self._refreshing = set()
+        self._keys_fetched = {}  # {issuer: monotonic time of last JWKS fetch for an unknown key id}
+        self._keys_flight = SingleFlight()
+
+    @staticmethod
+    @timed("oidc_jwks")
+    def _fetch_bundle(bundle):
+        """ Freshly fetched copy of a remote key bundle, raises UpdateFailed """
+        fresh = KeyBundle(
+            source=bundle.source, verify_ssl=bundle.verify_ssl, timeout=bundle.timeout,
+            cache_time=float("inf"),  # Replaced by ProviderCache, never refetched inline by oic
+        )
+        fresh.update()
+        return fresh
+
+    @classmethod
+    def _fetch_keys(cls, bundles):
+        return [cls._fetch_bundle(bundle) if bundle.remote else bundle for bundle in bundles]
+
+    @classmethod
+    @timed("oidc_discovery")
+    def _fetch(cls, issuer, client_secret):
+        config = http_for(issuer).get(
+            f"{issuer}/.well-known/openid-configuration", headers={"Content-type": "application/json"}
+        ).json()
+        provider_config = ProviderConfigurationResponse(**config)
+        keyjar = KeyJar()
+        owner = provider_config.get("issuer", issuer)
+        keyjar.load_keys(provider_config, owner)
+        keyjar.issuer_keys[owner] = cls._fetch_keys(keyjar.issuer_keys.get(owner, []))
+        if client_secret:
+            keyjar.add_symmetric("", str(client_secret))
+        return provider_config, keyjar
+
+    def load(self, issuer, ttl, client_secret=None):
+        provider_config, keyjar = self._fetch(issuer, client_secret)
+        with self._lock:
+            now = monotonic()
+            self._entries[issuer] = (now + ttl, now + ttl * self.REFRESH_AHEAD, provider_config, keyjar)
+        return provider_config, keyjar
+
+    def _refresh(self, issuer, ttl, client_secret, logger):
+        try:
+            self.load(issuer, ttl, client_secret)
+        except:  # pylint: disable=W0702
+            logger.exception("Failed to refresh OIDC provider configuration")
+        finally:
+            with self._lock:
+                self._refreshing.discard(issuer)
+
+    def ready(self, issuer):
+        """
+        Discovery for ``issuer`` was loaded at least once. Entries are refreshed by requests that use them,
+        an expired one only means no such request came since.
+        """
+        return issuer in self._entries
+
+    def _refresh_keys(self, owner, keyjar, min_interval):
+        with self._lock:
+            if monotonic() < self._keys_fetched.get(owner, float("-inf")) + min_interval:
+                return False
+            self._keys_fetched[owner] = monotonic()
+        try:
+            bundles = self._fetch_keys(keyjar.issuer_keys.get(owner, []))
+        except Exception:  # pylint: disable=W0703
+            current_app.logger.warning("Failed to refetch JWKS of %s, keeping current keys", owner)
+            return False
+        keyjar.issuer_keys[owner] = bundles
+        return True
+
+    def refresh_keys(self, owner, keyjar, min_interval):
+        """
+        Refetch provider keys for a token signed with an unknown key id, at most once per ``min_interval``
+        seconds per issuer. Concurrent callers share one fetch, keys are swapped in only when it succeeds.
+        """
+        return self._keys_flight.do(owner, self._refresh_keys, owner, keyjar, min_interval)
+
+    def get(self, issuer, ttl, client_secret=None):
+        entry = self._entries.get(issuer)
+        if entry is None or entry[0] <= monotonic():
+            return self.load(issuer, ttl, client_secret)
+        _, refresh_at, provider_config, keyjar = entry
+        if refresh_at <= monotonic():
+            with self._lock:
+                start = issuer not in self._refreshing
+                self._refreshing.add(issuer)
+            if start:
+                Thread(
+                    target=self._refresh, args=(issuer, ttl, client_secret, current_app.logger), daemon=True
+                ).start()
+        return provider_config, keyjar
+
+
+provider_cache = ProviderCache()
 
 
 def create_oidc_client(issuer=None, registration_info=None):
     if "oidc" not in g:
+        provider_config, keyjar = provider_cache.get(
+            issuer, current_app.config["oidc"].get("provider_config_ttl", 3600), registration_info.get("client_secret")
+        )
         g.oidc = Client(client_authn_method=CLIENT_AUTHN_METHOD)
-        config = get(f"{issuer}/.well-known/openid-configuration", headers={"Content-type": "application/json"}).json()
-        provider_config = ProviderConfigurationResponse(**config)
-        g.oidc.handle_provider_config(provider_config, issuer)
+        g.oidc.handle_provider_config(provider_config, issuer, keys=False)
         g.oidc.store_registration_info(
             RegistrationResponse(**registration_info)
         )
+        g.oidc.keyjar = keyjar  # Shared, already holds provider keys and client secret
         g.oidc.redirect_uris.append(f"{g.oidc.registration_response['redirect_uris'][0]}/callback")
     return g.oidc
 
 
+def _origin(proto, host, port):
+    if (proto == "http" and port != "80") or (proto == "https" and port != "443"):
+        return f"{proto}://{host}:{port}"
+    return f"{proto}://{host}"
+
+
+def _location_allowed(location):
+    """
+    Login returns to paths on this host, or to origins of auth.login_allowed_redirect_urls,
+    login_default_redirect_url and logout_allowed_redirect_urls.
+    A signed location still comes from forwarded headers anyone can set on their own request.
+    """
+    uri = location.get("X-Forwarded-Uri", "")
+    if not uri.startswith("/") or uri[1:2] in ("/", "\\"):
+        return False
+    if not all(header in location for header in ("X-Forwarded-Proto", "X-Forwarded-Host", "X-Forwarded-Port")):
+        return True
+    auth_settings = current_app.config["auth"]
+    urls = [auth_settings.get("login_default_redirect_url")]
+    for key in ("login_allowed_redirect_urls", "logout_allowed_redirect_urls"):
+        urls.extend(auth_settings.get(key) or ())
+    allowed = set()
+    for url in filter(None, urls):
+        parts = urlsplit(url)
+        allowed.add(_origin(parts.scheme, parts.hostname, str(parts.port or DEFAULT_PORTS.get(parts.scheme))))
+    origin = _origin(location["X-Forwarded-Proto"], location["X-Forwarded-Host"], location["X-Forwarded-Port"])
+    return origin.lower() in allowed
+
+
 def _build_redirect_url():
     for header in ("X-Forwarded-Proto", "X-Forwarded-Host", "X-Forwarded-Port"):
         if header not in session:
@@ -50,35 +210,71 @@ def _build_redirect_url():
     proto = session.pop("X-Forwarded-Proto")
     host = session.pop("X-Forwarded-Host")
     port = session.pop("X-Forwarded-Port")
-    if (proto == "http" and port != "80") or (proto == "https" and port != "443"):
-        port = f":{port}"
-    else:
-        port = ""
     uri = session.pop("X-Forwarded-Uri")
-    return f"{proto}://{host}{port}{uri}"
+    return f"{_origin(proto, host, port)}{uri}"
 
 
-def decode_id_token(id_token):
-    segments = id_token.split('.')
-    if len(segments) != 3:
-        raise Exception('Wrong number of segments in token: %s' % id_token)
-    b64string = segments[1]
-    padded = b64string + '=' * (4 - len(b64string) % 4)
-    padded = base64.b64decode(padded)
-    return loads(padded)
+@timed("oidc_jwt_verify")
+def _verify_access_token(access_token, realm=DEFAULT_REALM):
+    """ Check access token signature against cached issuer JWKS, then exp, iss and aud """
+    oidc_config = realm_settings(realm)
+    provider_config, keyjar = provider_cache.get(
+        oidc_config["issuer"], oidc_config.get("provider_config_ttl", 3600),
+        oidc_config["registration"].get("client_secret")
+    )
+    issuer = provider_config.get("issuer", oidc_config["issuer"])
+    try:
+        kid = decode_id_token(access_token, segment=0).get("kid")
+    except Exception:  # pylint: disable=W0703
+        return False, {}
+    keys = keyjar.get_verify_key(owner=issuer, kid=kid)
+    if kid and not any(key.kid == kid for key in keys) and \
+            provider_cache.refresh_keys(issuer, keyjar, oidc_config.get("jwks_refresh_interval", 60)):
+        keys = keyjar.get_verify_key(owner=issuer, kid=kid)  # Keys were probably rotated
+    try:
+        claims = JWS().verify_compact(access_token, keys)
+    except Exception:  # pylint: disable=W0703
+        return False, {}
+    if not isinstance(claims, dict):
+        return False, {}
+    audience = oidc_config.get("audience", oidc_config["registration"]["client_id"])
+    if isinstance(audience, str):
+        audience = [audience]
+    token_audience = claims.get("aud", [])
+    if isinstance(token_audience, str):
+        token_audience = [token_audience]
+    exp = claims.get("exp")
+    if not isinstance(exp, (int, float)) or exp < int(time()) or claims.get("iss") != issuer:
+        return False, {}
+    if claims.get("azp") not in audience and not set(token_audience) & set(audience):
+        return False, {}
+    # Service account tokens and tokens issued without profile scope carry no preferred_username
+    username = claims.get("preferred_username") or claims.get("sub")
+    if not username:
+        return False, {}
+    auth_data = {
+        "username": username,
+        "groups": claims.get("groups", []),
+        "exp": exp
+    }
+    return True, auth_data
 
 
-def _validate_basic_auth(login, password, scope="openid groups"):
-    url = f'{current_app.config["oidc"]["issuer"]}/protocol/openid-connect/token'
+@timed("oidc_password_grant")
+def _validate_basic_auth(login, password, scope="openid groups", realm=DEFAULT_REALM):
+    oidc_config = realm_settings(realm)
+    url = f'{oidc_config["issuer"]}/protocol/openid-connect/token'
     data = {
         "username": login,
         "password": password,
         "scope": scope,
         "grant_type": "password",
-        "client_id": current_app.config["oidc"]["registration"]["client_id"],
-        "client_secret": current_app.config["oidc"]["registration"]["client_secret"],
+        "client_id": oidc_config["registration"]["client_id"],
+        "client_secret": oidc_config["registration"]["client_secret"],
     }
-    resp = loads(post(url, data=data, headers={"content-type": "application/x-www-form-urlencoded"}).content)
+    resp = loads(http_for(oidc_config["issuer"]).post(
+        url, data=data, headers={"content-type": "application/x-www-form-urlencoded"}
+    ).content)
     if resp.get("error"):
         return False, {}
     id_token = decode_id_token(resp.get("id_token"))
@@ -89,16 +285,30 @@ def _validate_basic_auth(login, password, scope="openid groups"):
     return True, auth_data
 
 
-def _validate_token_auth(refresh_token, scope="openid groups"):
-    url = f'{current_app.config["oidc"]["issuer"]}/protocol/openid-connect/token'
+def _validate_token_auth(refresh_token, scope="openid groups", realm=None):
+    """ Validate with the realm that issued the token unless ``realm`` is given """
+    if realm is None:
+        realm = realm_for_token(refresh_token)
+    oidc_config = realm_settings(realm)
+    if oidc_config.get("local_token_verification", False):
+        try:
+            token_type = decode_id_token(refresh_token).get("typ")
+        except Exception:  # pylint: disable=W0703
+            token_type = None  # Not a JWT, let the IdP decide
+        if token_type == "Bearer":
+            return _verify_access_token(refresh_token, realm)
+    url = f'{oidc_config["issuer"]}/protocol/openid-connect/token'
     data = {
         "refresh_token": refresh_token,
         "scope": scope,
         "grant_type": "refresh_token",
-        "client_id": current_app.config["oidc"]["registration"]["client_id"],
-        "client_secret": current_app.config["oidc"]["registration"]["client_secret"],
+        "client_id": oidc_config["registration"]["client_id"],
+        "client_secret": oidc_config["registration"]["client_secret"],
     }
-    resp = loads(post(url, data=data, headers={"content-type": "application/x-www-form-urlencoded"}).content)
+    with timer("oidc_refresh_grant"):
+        resp = loads(http_for(oidc_config["issuer"]).post(
+            url, data=data, headers={"content-type": "application/x-www-form-urlencoded"}
+        ).content)
     if resp.get("error"):
         return False, {}
     id_token = decode_id_token(resp.get("id_token"))
@@ -109,17 +319,33 @@ def _validate_token_auth(refresh_token, scope="openid groups"):
     return True, auth_data
 
 
-def _delete_refresh_token(refresh_token: str) -> None:
-    url = f'{current_app.config["oidc"]["issuer"]}/protocol/openid-connect/logout'
+@timed("oidc_logout")
+def _delete_refresh_token(refresh_token: str) -> bool:
+    """ Revoke at the IdP, False when it is worth retrying. Runs on revocation queue workers """
+    oidc_config = realm_settings(realm_for_token(refresh_token))
+    url = f'{oidc_config["issuer"]}/protocol/openid-connect/logout'
     data = {
         "refresh_token": refresh_token,
-        "client_id": current_app.config["oidc"]["registration"]["client_id"],
-        "client_secret": current_app.config["oidc"]["registration"]["client_secret"],
+        "client_id": oidc_config["registration"]["client_id"],
+        "client_secret": oidc_config["registration"]["client_secret"],
     }
-    post(url,
-         data=data,
-         params={"delete_offline_token": True},
-         headers={"content-type": "application/x-www-form-urlencoded"})
+    resp = http_for(oidc_config["issuer"]).post(url,
+                                                data=data,
+                                                params={"delete_offline_token": True},
+                                                headers={"content-type": "application/x-www-form-urlencoded"})
+    # 400 is an already invalid token, nothing left to revoke
+    return resp.status_code < 300 or resp.status_code == 400
+
+
+def revoke_refresh_token(refresh_token: str, auth_header: Optional[str] = None) -> bool:
+    """
+    Queue revocation at the IdP, ``auth_header`` carrying the token is refused from now on.
+    False when the revocation queue is full.
+    """
+    if auth_header is not None:
+        redis_client = RedisClient()
+        redis_client.set_rejected(redis_client.key(auth_header), ttl=Config.TOKEN_TTL_BEARER)
+    return revocation_queue.enqueue(refresh_token)
 
 
 def _auth_request(scope="openid", redirect="/callback", response_type="code"):
@@ -146,12 +372,16 @@ def _do_logout(to=None):
     if to is not None and to in current_app.config["auth"]["logout_allowed_redirect_urls"]:
         return_to = to
     client = create_oidc_client(current_app.config["oidc"]["issuer"], current_app.config["oidc"]["registration"])
+    request_args = {"redirect_uri": return_to}
+    if session.get("id_token_hint"):  # Grant may have been obtained by another replica
+        request_args["id_token_hint"] = session["id_token_hint"]
     try:
         end_req = client.construct_EndSessionRequest(
-            state=session["state"],
-            request_args={"redirect_uri": return_to}
+            state=session.get("state", ""),
+            request_args=request_args,
+            prop="id_token_hint"
         )
-    except GrantError:
+    except (GrantError, MissingParameter):
         clear_session(session)
         return f"{client.end_session_endpoint}?redirect_uri={return_to}"
     logout_url = end_req.request(client.end_session_endpoint)
@@ -163,6 +393,10 @@ def _do_logout(to=None):
 
 @bp.route("/login")
 def login():
+    location = load_location(current_app, request.args.get("next"))
+    if _location_allowed(location):
+        for header, value in location.items():
+            session[header] = value
     return redirect(_auth_request(scope="openid groups"), 302)
 
 
@@ -176,6 +410,26 @@ def new_token():
     return redirect(_auth_request(scope="openid offline_access groups"))
 
 
+@bp.route("/token/revoke", methods=["POST"])
+def revoke_token():
+    """
+    Log out a service account: Authorization: Bearer <refresh token>, revoked in background.
+    Rate limited like credential validation, as anyone can call it with made up tokens.
+    """
+    auth_key, _, refresh_token = request.headers.get("Authorization", "").strip().partition(" ")
+    if auth_key.lower() != "bearer" or not refresh_token.strip():
+        return make_response("KO", 401)
+    redis_client = RedisClient()
+    if not redis_client.consume({
+        f"credential:{redis_client.key(request.headers['Authorization'])}": Config.RATE_LIMIT_CREDENTIAL,
+        f"client:{_client_ip()}": Config.RATE_LIMIT_CLIENT,
+    }):
+        return make_response("Too Many Requests", 429)
+    if not revoke_refresh_token(refresh_token.strip(), request.headers["Authorization"]):
+        return make_response("Revocation queue is full", 503)
+    return make_response("Accepted", 202)
+
+
 @bp.route("/logout")
 def logout():
     logout_url = _do_logout()
@@ -188,14 +442,22 @@ def callback():
     auth_resp = client.parse_response(AuthorizationResponse, info=dumps(request.args.to_dict()), sformat="json")
     if "state" not in session or auth_resp["state"] != session["state"]:
         return redirect(current_app.config["endpoints"]["access_denied"], 302)
-    access_token_resp = client.do_access_token_request(
-        state=auth_resp["state"],
-        request_args={"code": auth_resp["code"]},
-        authn_method="client_secret_basic"
-    )
+    # Login may have started on another replica, pending grant state comes from the shared session
+    client.state2nonce[session["state"]] = session.get("nonce", "")
+    try:
+        with timer("oidc_code_exchange"):
+            access_token_resp = client.do_access_token_request(
+                state=auth_resp["state"],
+                request_args={"code": auth_resp["code"]},
+                authn_method="client_secret_basic"
+            )
+    except ParameterError:
+        return redirect(current_app.config["endpoints"]["access_denied"], 302)
     session_state = session.pop("state")
     session_nonce = session.pop("nonce")
     id_token = dict(access_token_resp["id_token"])
+    if current_app.config["session_claims"] is not None:
+        id_token = {key: value for key, value in id_token.items() if key in current_app.config["session_claims"]}
     if access_token_resp["refresh_expires_in"] == 0:
         session["X-Forwarded-Uri"] = f"/token?id={access_token_resp['refresh_token']}"
     redirect_to = _build_redirect_url()
@@ -204,6 +466,8 @@ def callback():
     session["state"] = session_state
     session["nonce"] = session_nonce
     session["auth_attributes"] = id_token
+    session["login_id"] = rndstr(32)  # Keys per-login decision cache
+    session["id_token_hint"] = access_token_resp["id_token"].jwt or ""
     session["auth"] = True
     session["auth_errors"] = []
     session["auth_nameid"] = ""
@@ -12,75 +12,343 @@
 #   See the License for the specific language governing permissions and
 #   limitations under the License.
 
-import importlib
-from json import dumps, loads
+import binascii
+import hmac
+from json import dumps
 from base64 import b64decode
+from concurrent.futures import ThreadPoolExecutor
+from threading import Lock
 from time import time
+from typing import Dict, List, Optional, Tuple
+from urllib.parse import urlencode
 
-from flask import current_app, session, request, redirect, make_response, Blueprint
+from flask import current_app, session, request, redirect, make_response, Blueprint, g
+from redis.exceptions import LockError
 
-from auth.drivers.oidc import _validate_basic_auth, _validate_token_auth
+from auth.config import Config
+from auth.utils import codec, metrics
 from auth.utils.redis_client import RedisClient
+from auth.utils.session import FORWARDED_HEADERS, sign_location
+from auth.utils.single_flight import SingleFlight
 
 bp = Blueprint("root", __name__)
+single_flight = SingleFlight()
+refresh_executor = ThreadPoolExecutor(max_workers=Config.TOKEN_REFRESH_WORKERS, thread_name_prefix="refresh")
+batch_executor = ThreadPoolExecutor(max_workers=Config.BATCH_AUTH_WORKERS, thread_name_prefix="batch-auth")
+refreshing = set()
+refreshing_lock = Lock()
 
+STATIC_PREFIX = "/static"
+STATIC_SUFFIXES = (".ico", ".js", ".css")
+VERDICTS = {200: "allow", 302: "login", 401: "deny", 429: "rate_limited"}
+STATUS_TEXT = {200: "OK", 401: "KO", 429: "Too Many Requests"}
 
-def handle_auth(auth_header: str):
-    redis_client = RedisClient()
-    if redis_client.check_auth_token(auth_header=auth_header):
-        return make_response("OK", 200)
+
+def _token_ttl(auth_header: str) -> int:
+    if auth_header.lstrip()[:6].lower() == "basic ":
+        return Config.TOKEN_TTL_BASIC
+    return Config.TOKEN_TTL_BEARER
+
+
+def _validate_auth_header(redis_client: RedisClient, auth_header: str, key_hex: str, refresh: bool = False,
+                          buckets: Optional[Dict[str, Tuple[float, float]]] = None) -> int:
+    """
+    Validate credentials upstream, one grant at a time across workers. Returns status: 200, 401 or 429.
+
+    With ``refresh`` a cached identity is revalidated unless another worker already did it.
+    Rate limit ``buckets`` are only charged when an upstream grant is actually made,
+    requests waiting on another worker's grant take its result for free.
+    """
     try:
         auth_key, auth_value = auth_header.strip().split(" ")
     except ValueError:
-        return make_response("KO", 401)
-    else:
-        if auth_key.lower() == "basic":
+        return 401
+    if auth_key.lower() not in ("basic", "bearer"):
+        return 401
+    if auth_key.lower() == "basic":
+        try:
             username, password = b64decode(auth_value.strip()).decode().split(":", 1)
-            _, auth_data = _validate_basic_auth(username, password)
-            if _:
-                redis_client.set_auth_token(auth_header=auth_header, value=dumps(auth_data))
-                return make_response("OK", 200)
-        elif auth_key.lower() == "bearer":
-            _, auth_data = _validate_token_auth(auth_value)
-            if _:
-                redis_client.set_auth_token(auth_header=auth_header, value=dumps(auth_data))
-                return make_response("OK", 200)
-    return make_response("KO", 401)
+        except (ValueError, binascii.Error, UnicodeDecodeError):
+            return 401
+    from auth.drivers.oidc import _validate_basic_auth, _validate_token_auth
+    ttl = _token_ttl(auth_header)
+    lock = redis_client.lock(key_hex)
+    acquired = lock.acquire()
+    try:
+        if acquired:  # Another worker may have finished validation while we were waiting
+            value, rejected, ttl_left = redis_client.lookup(key_hex, local=not refresh, primary=True)
+            if rejected:
+                return 401
+            if value is not None and (not refresh or ttl_left is None or ttl_left > ttl * Config.TOKEN_REFRESH_AHEAD):
+                return 200
+        if buckets and not redis_client.consume(buckets):
+            return 429
+        if auth_key.lower() == "basic":
+            valid, auth_data = _validate_basic_auth(username, password)
+        else:
+            valid, auth_data = _validate_token_auth(auth_value)
+        if valid:
+            if "exp" in auth_data:  # Never cache past token expiry
+                ttl = min(ttl, auth_data["exp"] - int(time()))
+            if ttl > 0:
+                redis_client.set_auth_token(key_hex, value=codec.dumps(auth_data), ttl=ttl)
+        else:
+            redis_client.set_rejected(key_hex)
+        return 200 if valid else 401
+    finally:
+        if acquired:
+            try:
+                lock.release()
+            except LockError:
+                pass  # Lock expired, nothing to release
+
+
+def _revalidate(app, auth_header: str, key_hex: str) -> None:
+    try:
+        with app.app_context():
+            single_flight.do(key_hex, _validate_auth_header, RedisClient(), auth_header, key_hex, True)
+    except:  # pylint: disable=W0702
+        app.logger.exception("Failed to refresh cached credentials")
+    finally:
+        with refreshing_lock:
+            refreshing.discard(key_hex)
+
+
+def _keep_fresh(redis_client: RedisClient, auth_header: str, key_hex: str, value: bytes, ttl_left: Optional[float]):
+    """
+    Revalidate hot entries in background ahead of expiry, or slide their expiry.
+
+    Entries already cached until token expiry are left alone, neither can extend them.
+    """
+    if ttl_left is None:
+        return
+    ttl = _token_ttl(auth_header)
+    refresh = ttl_left <= ttl * Config.TOKEN_REFRESH_AHEAD
+    if not refresh and not (Config.TOKEN_SLIDING_EXPIRY and ttl_left <= ttl / 2):
+        return
+    identity = codec.loads(value)
+    exp = identity.get("exp") if isinstance(identity, dict) else None
+    if exp is not None:
+        ttl = min(ttl, exp - int(time()))
+    if ttl <= ttl_left + 1:
+        return
+    if not refresh:
+        redis_client.touch_auth_token(key_hex, value, ttl)
+        return
+    with refreshing_lock:
+        if key_hex in refreshing:
+            return
+        refreshing.add(key_hex)
+    refresh_executor.submit(_revalidate, current_app._get_current_object(), auth_header, key_hex)
+
+
+def _client_ip() -> str:
+    """ Client address as seen by the outermost of TRUSTED_PROXIES proxies, entries left of it come from the client """
+    hops = [hop.strip() for hop in request.headers.get("X-Forwarded-For", "").split(",") if hop.strip()]
+    if Config.TRUSTED_PROXIES <= 0 or len(hops) < Config.TRUSTED_PROXIES:
+        return request.remote_addr or ""
+    return hops[-Config.TRUSTED_PROXIES]
+
+
+def _validate_miss(redis_client: RedisClient, auth_header: str, key_hex: str, client_ip: Optional[str]) -> int:
+    """
+    Status for credentials missing from cache: validated once per key, rate limited when a grant is made.
+    Without ``client_ip`` the client bucket is left to the caller.
+    """
+    buckets = {f"credential:{key_hex}": Config.RATE_LIMIT_CREDENTIAL}
+    if client_ip is not None:
+        buckets[f"client:{client_ip}"] = Config.RATE_LIMIT_CLIENT
+    return single_flight.do(key_hex, _validate_auth_header, redis_client, auth_header, key_hex, buckets=buckets)
+
+
+def _validate_miss_in_context(app, auth_header: str, key_hex: str, client_ip: Optional[str]) -> int:
+    with app.app_context():
+        return _validate_miss(RedisClient(), auth_header, key_hex, client_ip)
+
+
+@metrics.timed("handle_auth")
+def handle_auth(auth_header: str, key_hex: Optional[str] = None):
+    redis_client = RedisClient()
+    if key_hex is None:
+        key_hex = redis_client.key(auth_header)
+    value, rejected, ttl_left = redis_client.lookup(key_hex)
+    if value is not None:
+        _keep_fresh(redis_client, auth_header, key_hex, value, ttl_left)
+        return make_response("OK", 200)
+    if rejected:
+        return make_response("KO", 401)
+    status = _validate_miss(redis_client, auth_header, key_hex, _client_ip())
+    return make_response(STATUS_TEXT[status], status)
+
+
+@metrics.timed("handle_auth_batch")
+def handle_auth_batch(auth_headers: List[str]) -> List[dict]:
+    """
+    Verdict and identity per header: cached entries in one Redis round trip,
+    misses validated concurrently on ``batch_executor``. Each miss takes a token from the client bucket
+    up front, misses it has no tokens left for are answered 429.
+    """
+    redis_client = RedisClient()
+    keys_hex = [redis_client.key(auth_header) for auth_header in auth_headers]
+    cached = redis_client.lookup_many(keys_hex)
+    statuses = dict()
+    misses = dict()
+    for auth_header, key_hex in zip(auth_headers, keys_hex):
+        if key_hex in statuses or key_hex in misses:
+            continue
+        value, rejected, ttl_left = cached[key_hex]
+        if value is not None:
+            _keep_fresh(redis_client, auth_header, key_hex, value, ttl_left)
+            statuses[key_hex] = 200
+        elif rejected:
+            statuses[key_hex] = 401
+        else:
+            misses[key_hex] = auth_header
+    if misses:
+        granted = redis_client.consume({f"client:{_client_ip()}": Config.RATE_LIMIT_CLIENT}, cost=len(misses))
+        limited = list(misses)[granted:]
+        statuses.update(dict.fromkeys(limited, 429))
+        for key_hex in limited:
+            del misses[key_hex]
+    app = current_app._get_current_object()
+    pending = {
+        key_hex: batch_executor.submit(_validate_miss_in_context, app, auth_header, key_hex, None)
+        for key_hex, auth_header in misses.items()
+    }
+    for key_hex, future in pending.items():
+        statuses[key_hex] = future.result()
+    results = list()
+    for key_hex in keys_hex:
+        status = statuses[key_hex]
+        value = cached[key_hex][0]
+        if value is None and status == 200:
+            value = redis_client.get_auth_token(key_hex)  # Kept in local cache by validation
+        results.append({
+            "status": status,
+            "verdict": VERDICTS[status],
+            "identity": codec.loads(value) if value is not None else {},
+        })
+    return results
+
+
+def _with_next(url, token):
+    if not token:
+        return url
+    return f"{url}{'&' if '?' in url else '?'}{urlencode({'next': token})}"
+
+
+def _login_redirect(url):
+    """
+    Redirect to login with original request location in a signed ``next`` parameter, so login callback
+    can return there. Session is only created once login actually starts.
+    """
+    location = {header: request.headers[header] for header in FORWARDED_HEADERS if header in request.headers}
+    if "X-Forwarded-Uri" in request.headers and "/api/v1" in "X-Forwarded-Uri":
+        if "Referer" in request.headers and "/api/v1" not in "Referer":
+            location["X-Forwarded-Uri"] = request.headers["Referer"]
+        else:
+            location["X-Forwarded-Uri"] = request.base_url
+    token = sign_location(current_app, location) if location else None
+    return redirect(_with_next(url, token), 302)
+
+
+@bp.after_request
+def record_metrics(response):
+    if request.endpoint == "root.auth":
+        target = request.args.get("target", "raw")
+        if "Authorization" in request.headers:
+            target = "token"
+        elif target not in current_app.config["mapper_registry"]:
+            target = "unknown"
+        outcome = VERDICTS.get(response.status_code, "error")
+        metrics.VERDICTS.labels(outcome, target).inc()
+    if Config.SERVER_TIMING and g.get("server_timing"):
+        response.headers["Server-Timing"] = metrics.server_timing_header()
+    return response
+
+
+@bp.route("/metrics")
+def prometheus_metrics():
+    data, content_type = metrics.export()
+    return make_response(data, 200, {"Content-Type": content_type})
+
+
+@bp.route("/ready")
+def ready():
+    """ Readiness: Redis answers and OIDC discovery is loaded for every realm """
+    checks = dict()
+    try:
+        checks["redis"] = bool(RedisClient().ping())
+    except:  # pylint: disable=W0702
+        checks["redis"] = False
+    if "oidc" in current_app.config:
+        from auth.drivers.oidc import provider_cache
+        checks["oidc"] = all(
+            provider_cache.ready(settings["issuer"]) for settings in current_app.config["oidc_realms"].values()
+        )
+    return make_response(dumps(checks), 200 if all(checks.values()) else 503, {"Content-Type": "application/json"})
+
+
+@bp.route("/reload", methods=["POST"])
+def reload():
+    """ Re-read settings and Vault secrets, allowed with global.config_reload.admin_token """
+    admin_token = current_app.config["global"].get("config_reload", dict()).get("admin_token")
+    if not admin_token:
+        return make_response("Not Found", 404)
+    if not hmac.compare_digest(request.headers.get("X-Admin-Token", "").encode(), str(admin_token).encode()):
+        return make_response("Forbidden", 403)
+    try:
+        current_app.extensions["reload_config"](current_app._get_current_object())
+    except:  # pylint: disable=W0702
+        current_app.logger.exception("Configuration reload failed, keeping previous configuration")
+        return make_response("Reload failed", 500)
+    return make_response("OK", 200)
+
+
+@bp.route("/auth/batch", methods=["POST"])
+def auth_batch():
+    """ Authorize a list of Authorization header values: {"headers": [...]} -> {"results": [...]} """
+    body = request.get_json(silent=True)
+    auth_headers = body.get("headers") if isinstance(body, dict) else None
+    if not isinstance(auth_headers, list) or not all(isinstance(item, str) for item in auth_headers):
+        return make_response(dumps({"error": "expected {\"headers\": [\"<Authorization value>\", ...]}"}), 400,
+                             {"Content-Type": "application/json"})
+    if len(auth_headers) > Config.BATCH_AUTH_MAX_SIZE:
+        return make_response(dumps({"error": f"at most {Config.BATCH_AUTH_MAX_SIZE} headers per batch"}), 413,
+                             {"Content-Type": "application/json"})
+    results = handle_auth_batch(auth_headers)
+    for result in results:
+        metrics.VERDICTS.labels(result["verdict"], "batch").inc()
+    return make_response(dumps({"results": results}), 200, {"Content-Type": "application/json"})
 
 
 @bp.route("/auth")
 def auth():
-    if "X-Forwarded-Uri" in request.headers:
-        if request.headers["X-Forwarded-Uri"].startswith("/static") and \
-                any(request.headers["X-Forwarded-Uri"].endswith(res) for res in [".ico", ".js", ".css"]):
-            return make_response("OK")
+    forwarded_uri = request.headers.get("X-Forwarded-Uri", "")
+    if forwarded_uri.startswith(STATIC_PREFIX) and forwarded_uri.endswith(STATIC_SUFFIXES):
+        return make_response("OK")
     # Check if need to login
     target = request.args.get("target")
     scope = request.args.get("scope")
-    for header in ("X-Forwarded-Proto", "X-Forwarded-Host", "X-Forwarded-Port", "X-Forwarded-Uri"):
-        if header in request.headers:
-            session[header] = request.headers[header]
     if "Authorization" in request.headers:
         return handle_auth(auth_header=request.headers.get("Authorization", ""))
-    if "X-Forwarded-Uri" in request.headers and "/api/v1" in "X-Forwarded-Uri":
-        if "Referer" in request.headers and "/api/v1" not in "Referer":
-            session["X-Forwarded-Uri"] = request.headers["Referer"]
-        else:
-            session["X-Forwarded-Uri"] = request.base_url
     if not session.get("auth_attributes") or session["auth_attributes"]["exp"] < int(time()):
-        return redirect(current_app.config["auth"]["login_handler"], 302)
+        return _login_redirect(current_app.config["auth"]["login_handler"])
     if not session.get("auth", False) and not current_app.config["global"]["disable_auth"]:
         # Redirect to login
-        return redirect(current_app.config["auth"].get("auth_redirect",
-                                                       f"{request.base_url}{request.script_root}/login"))
+        return _login_redirect(current_app.config["auth"].get("auth_redirect",
+                                                              f"{request.base_url}{request.script_root}/login"))
     if target is None:
         target = "raw"
     # Map auth response
     response = make_response("OK")
+    mapper = current_app.config["mapper_registry"].get(target)
+    if mapper is None:
+        current_app.logger.error(f"Failed to map auth data: unknown target {target}")
+        return response
     try:
-        mapper = importlib.import_module(f"auth.mappers.{target}")
         response = mapper.auth(scope, response)
-    except (ImportError, AttributeError, TypeError):
+    except (AttributeError, TypeError):
         from traceback import format_exc
         current_app.logger.error(f"Failed to map auth data {format_exc()}")
     except NameError:
@@ -90,14 +358,11 @@ def auth():
 
 def me_from_token(auth_header: str):
     redis_client = RedisClient()
-    try:
-        res = redis_client.get_auth_token(auth_header=auth_header)
-        res = loads(res)
-    except TypeError:
-        redis_client.clear_auth_token(auth_header=auth_header)
-        handle_auth(auth_header=auth_header)
-        res = loads(redis_client.get_auth_token(auth_header=auth_header))
-    return res
+    key_hex = redis_client.key(auth_header)
+    res = redis_client.get_auth_token(key_hex)
+    if res is None and handle_auth(auth_header, key_hex).status_code == 200:
+        res = redis_client.get_auth_token(key_hex)  # Kept in local cache by handle_auth
+    return codec.loads(res) if res is not None else {}
 
 
 @bp.route('/me', methods=["GET"])
@@ -120,7 +385,7 @@ def token():
 
 @bp.route("/login")
 def login():
-    return redirect(current_app.config["auth"]["login_handler"], 302)
+    return redirect(_with_next(current_app.config["auth"]["login_handler"], request.args.get("next")), 302)
 
 
 @bp.route("/logout")
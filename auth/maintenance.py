@@ -0,0 +1,140 @@
+#   Copyright 2020 getcarrier.io
+#
+#   Licensed under the Apache License, Version 2.0 (the "License");
+#   you may not use this file except in compliance with the License.
+#   You may obtain a copy of the License at
+#
+#       http://www.apache.org/licenses/LICENSE-2.0
+#
+#   Unless required by applicable law or agreed to in writing, software
+#   distributed under the License is distributed on an "AS IS" BASIS,
+#   WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#   See the License for the specific language governing permissions and
+#   limitations under the License.
+
+"""
+Session storage maintenance:
+
+    auth-maintenance sessions            # report session keys by state as JSON
+    auth-maintenance sessions --compact  # also delete orphaned sessions and re-encode pickled ones
+"""
+
+import json
+import sys
+from argparse import ArgumentParser
+from collections import Counter
+from time import time
+
+import redis
+
+from auth.config import Config
+from auth.utils.codec import MARKER, SessionSerializer
+
+ORPHANED = ("expired_login", "anonymous", "corrupt")
+# Change the key only if nobody wrote it since it was read: ARGV is read value, new value ("" deletes), ttl
+COMPARE_AND_SET_SCRIPT = """
+    if redis.call("GET", KEYS[1]) ~= ARGV[1] then
+        return 0
+    end
+    if ARGV[2] == "" then
+        return redis.call("DEL", KEYS[1])
+    end
+    redis.call("SET", KEYS[1], ARGV[2], "EX", tonumber(ARGV[3]))
+    return 1
+"""
+
+
+def classify(value, ttl, now, lifetime, pending_max_age):
+    """
+    Session state: active, expired_login (identity expired), pending_login (login started recently),
+    anonymous (never logged in) or corrupt
+    """
+    try:
+        data = SessionSerializer.loads(value)
+    except:  # pylint: disable=W0702
+        return "corrupt"
+    if not isinstance(data, dict):
+        return "corrupt"
+    attributes = data.get("auth_attributes")
+    if data.get("auth") and isinstance(attributes, dict):
+        return "active" if attributes.get("exp", 0) >= now else "expired_login"
+    age = lifetime - ttl if ttl >= 0 else lifetime
+    return "pending_login" if age <= pending_max_age else "anonymous"
+
+
+def sessions(rc, prefix="session:", compact=False, batch=1000, lifetime=31 * 24 * 3600, pending_max_age=3600):
+    """ Scan session keys, count and size them by state, with ``compact`` clean them up. Returns report dict """
+    compare_and_set = rc.register_script(COMPARE_AND_SET_SCRIPT)
+    counts, sizes = Counter(), Counter()
+    report = {"legacy": 0, "no_ttl": 0, "deleted": 0, "rewritten": 0}
+    now = time()
+    keys = list()
+    for key in rc.scan_iter(match=f"{prefix}*", count=batch):
+        keys.append(key)
+        if len(keys) >= batch:
+            _process(rc, compare_and_set, keys, counts, sizes, report, now, compact, lifetime, pending_max_age)
+            keys = list()
+    if keys:
+        _process(rc, compare_and_set, keys, counts, sizes, report, now, compact, lifetime, pending_max_age)
+    report["sessions"] = dict(counts)
+    report["bytes"] = dict(sizes)
+    report["orphaned"] = sum(counts[state] for state in ORPHANED)
+    return report
+
+
+def _process(rc, compare_and_set, keys, counts, sizes, report, now, compact, lifetime, pending_max_age):
+    pipe = rc.pipeline(transaction=False)
+    for key in keys:
+        pipe.get(key)
+        pipe.ttl(key)
+    results = pipe.execute()
+    pipe = rc.pipeline(transaction=False)
+    actions = list()
+    for key, value, ttl in zip(keys, results[::2], results[1::2]):
+        if value is None:
+            continue  # Expired while scanning
+        state = classify(value, ttl, now, lifetime, pending_max_age)
+        counts[state] += 1
+        sizes[state] += len(value)
+        legacy = state != "corrupt" and not value.startswith(MARKER)
+        report["legacy"] += legacy
+        report["no_ttl"] += ttl < 0
+        if not compact:
+            continue
+        if state in ORPHANED:
+            compare_and_set(keys=[key], args=[value, "", 0], client=pipe)
+            actions.append("deleted")
+        elif legacy or ttl < 0:
+            new_value = SessionSerializer.dumps(SessionSerializer.loads(value))
+            compare_and_set(keys=[key], args=[value, new_value, ttl if ttl > 0 else lifetime], client=pipe)
+            actions.append("rewritten")
+    for action, changed in zip(actions, pipe.execute()):
+        report[action] += bool(changed)  # Sessions written meanwhile are left alone
+
+
+def parse_args(args=None):
+    parser = ArgumentParser(description="Auth storage maintenance")
+    commands = parser.add_subparsers(dest="command", required=True)
+    sessions_parser = commands.add_parser("sessions", help="Report and compact Redis session keys")
+    sessions_parser.add_argument("--compact", action="store_true",
+                                 help="Delete orphaned sessions, re-encode pickled ones, expire ones without TTL")
+    sessions_parser.add_argument("--prefix", default="session:", help="Session key prefix")
+    sessions_parser.add_argument("--batch", type=int, default=1000, help="Keys per SCAN and pipeline")
+    sessions_parser.add_argument("--lifetime", type=int, default=31 * 24 * 3600,
+                                 help="Session lifetime in seconds, PERMANENT_SESSION_LIFETIME")
+    sessions_parser.add_argument("--pending-max-age", type=int, default=3600,
+                                 help="Seconds a not logged in session may wait for login before it is orphaned")
+    return parser.parse_args(args)
+
+
+def main(args=None):
+    args = parse_args(args)
+    rc = redis.Redis(connection_pool=Config.REDIS_POOL)
+    report = sessions(rc, prefix=args.prefix, compact=args.compact, batch=args.batch,
+                      lifetime=args.lifetime, pending_max_age=args.pending_max_age)
+    json.dump(report, sys.stdout, indent=2)
+    sys.stdout.write("\n")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,44 @@
+#   Copyright 2020 getcarrier.io
+#
+#   Licensed under the Apache License, Version 2.0 (the "License");
+#   you may not use this file except in compliance with the License.
+#   You may obtain a copy of the License at
+#
+#       http://www.apache.org/licenses/LICENSE-2.0
+#
+#   Unless required by applicable law or agreed to in writing, software
+#   distributed under the License is distributed on an "AS IS" BASIS,
+#   WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#   See the License for the specific language governing permissions and
+#   limitations under the License.
+
+import importlib
+from collections import namedtuple
+
+import pkg_resources
+
+from auth.utils.metrics import timed
+
+BUILTIN_MAPPERS = ("raw", "header", "json")
+MAPPERS_ENTRY_POINT = "auth.mappers"
+
+Mapper = namedtuple("Mapper", ("auth", "info"))
+
+
+def load_mappers(logger=None):
+    """ Resolve built-in and plugin (``auth.mappers`` entry point) mappers into {target: Mapper} """
+    registry = dict()
+    for name in BUILTIN_MAPPERS:
+        module = importlib.import_module(f"auth.mappers.{name}")
+        registry[name] = Mapper(timed(f"mapper_{name}_auth")(module.auth), timed(f"mapper_{name}_info")(module.info))
+    for entry_point in pkg_resources.iter_entry_points(MAPPERS_ENTRY_POINT):
+        try:
+            plugin = entry_point.load()
+            registry[entry_point.name] = Mapper(
+                timed(f"mapper_{entry_point.name}_auth")(plugin.auth),
+                timed(f"mapper_{entry_point.name}_info")(plugin.info),
+            )
+        except (ImportError, AttributeError):
+            if logger is not None:
+                logger.exception("Failed to load mapper %s", entry_point.name)
+    return registry
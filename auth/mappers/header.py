@@ -12,25 +12,40 @@
 #   See the License for the specific language governing permissions and
 #   limitations under the License.
 
-import jsonpath_rw
-
-from flask import current_app, redirect
+from flask import current_app, redirect, session
 from auth.mappers import raw
+from auth.utils.decision_cache import decision_cache, group_index
+
+
+def _groups(auth_info):
+    return group_index(auth_info["auth_attributes"]["groups"], current_app.config["global"].get("match_parent_groups"))
+
+
+def _decide(scope):
+    """ Scope headers, or None when user is not a member of scope group """
+    auth_info = info(scope)
+    groups = decision_cache.get(session.get("login_id"), "groups", lambda: _groups(auth_info))
+    if f"/{scope}" not in groups:
+        return None
+    headers = list()
+    try:
+        for header, getter in current_app.config["mapper_plans"]["header"][scope]:
+            headers.append((header, getter(auth_info)))
+    except:
+        current_app.logger.error("Failed to set scope headers")
+    return headers
 
 
 def auth(scope, response):
     """ Map auth data """
-    if scope not in current_app.config["mappers"]["header"]:
+    if scope not in current_app.config["mapper_plans"]["header"]:
         raise redirect(current_app.config["endpoints"]["access_denied"])
     response = raw.auth(scope, response)  # Set "raw" headers too
-    auth_info = info(scope)
-    if f"/{scope}" not in auth_info["auth_attributes"]["groups"]:
+    headers = decision_cache.get(session.get("login_id"), ("header", scope), lambda: _decide(scope))
+    if headers is None:
         raise NameError(f"User is not a memeber of {scope} group")
-    try:
-        for header, path in current_app.config["mappers"]["header"][scope].items():
-            response.headers[header] = jsonpath_rw.parse(path).find(auth_info)[0].value
-    except:
-        current_app.logger.error("Failed to set scope headers")
+    for header, value in headers:
+        response.headers[header] = value
     return response
 
 
@@ -14,7 +14,6 @@
 
 import urllib
 
-import jsonpath_rw
 from flask import current_app, request, session, redirect
 
 from auth.mappers import raw
@@ -31,13 +30,13 @@ def auth(scope, response):
 
 def info(scope):
     """ Map info data """
-    if scope not in current_app.config["mappers"]["json"]:
+    if scope not in current_app.config["mapper_plans"]["json"]:
         raise redirect(current_app.config["endpoints"]["access_denied"])
     auth_info = raw.info()
     result = {"raw": auth_info}
     try:
-        for key, path in current_app.config["mappers"]["json"][scope].items():
-            result[key] = jsonpath_rw.parse(path).find(auth_info)[0].value
+        for key, getter in current_app.config["mapper_plans"]["json"][scope]:
+            result[key] = getter(auth_info)
     except:  # pylint: disable=W0702
         from traceback import format_exc
         current_app.logger.error(f"Failed to set scope data {format_exc()}")
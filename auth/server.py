@@ -0,0 +1,97 @@
+#   Copyright 2020 getcarrier.io
+#
+#   Licensed under the Apache License, Version 2.0 (the "License");
+#   you may not use this file except in compliance with the License.
+#   You may obtain a copy of the License at
+#
+#       http://www.apache.org/licenses/LICENSE-2.0
+#
+#   Unless required by applicable law or agreed to in writing, software
+#   distributed under the License is distributed on an "AS IS" BASIS,
+#   WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#   See the License for the specific language governing permissions and
+#   limitations under the License.
+
+import os
+import signal
+import sys
+from glob import glob
+
+from gunicorn.app.base import BaseApplication  # pylint: disable=E0401
+from gunicorn.arbiter import Arbiter  # pylint: disable=E0401
+
+
+class ReloadingArbiter(Arbiter):
+    """ SIGHUP to the master reloads settings in each worker instead of restarting them with cold caches """
+
+    def handle_hup(self):
+        self.log.info("Hang up: %s, reloading configuration in workers", self.master_name)
+        self.kill_workers(signal.SIGHUP)
+
+
+class GeventServer(BaseApplication):  # pylint: disable=W0223
+    """
+    Gunicorn with gevent workers: Keycloak, Redis and Vault calls yield instead of blocking a worker.
+
+    The app is created inside each worker after gevent has patched the socket and threading modules.
+    """
+
+    def __init__(self, options):
+        self.options = options
+        super().__init__()
+
+    def load_config(self):
+        for key, value in self.options.items():
+            self.cfg.set(key, value)
+
+    def load(self):
+        from auth.app import create_app
+        return create_app()
+
+    def run(self):
+        try:
+            ReloadingArbiter(self).run()
+        except RuntimeError as error:
+            print(f"\nError: {error}\n", file=sys.stderr)
+            sys.stderr.flush()
+            sys.exit(1)
+
+
+def _metrics_dir():
+    """ Prometheus multiprocess directory, only the lowercase name is read by prometheus-client 0.8 """
+    return os.environ.get("prometheus_multiproc_dir")
+
+
+def _clear_metrics(arbiter):  # pylint: disable=W0613
+    """ Stale worker files from a previous run would be summed into the new counters """
+    os.makedirs(_metrics_dir(), exist_ok=True)
+    for path in glob(os.path.join(_metrics_dir(), "*.db")):
+        os.remove(path)
+
+
+def _worker_exited(arbiter, worker):  # pylint: disable=W0613
+    from prometheus_client import multiprocess
+    multiprocess.mark_process_dead(worker.pid)
+
+
+def _warn_metrics(arbiter):
+    arbiter.log.warning(
+        "prometheus_multiproc_dir is not set: /metrics shows the worker that answered, "
+        "counters from %s workers are not aggregated", arbiter.num_workers
+    )
+
+
+def serve(host, port, workers, concurrency, timeout=30):
+    options = {
+        "bind": f"{host}:{port}",
+        "workers": workers,
+        "worker_class": "gevent",
+        "worker_connections": concurrency,
+        "timeout": timeout,
+        "preload_app": False,
+    }
+    if _metrics_dir():
+        options.update(on_starting=_clear_metrics, child_exit=_worker_exited)
+    elif workers > 1:
+        options.update(on_starting=_warn_metrics)
+    GeventServer(options).run()
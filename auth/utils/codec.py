@@ -0,0 +1,86 @@
+#   Copyright 2020 getcarrier.io
+#
+#   Licensed under the Apache License, Version 2.0 (the "License");
+#   you may not use this file except in compliance with the License.
+#   You may obtain a copy of the License at
+#
+#       http://www.apache.org/licenses/LICENSE-2.0
+#
+#   Unless required by applicable law or agreed to in writing, software
+#   distributed under the License is distributed on an "AS IS" BASIS,
+#   WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#   See the License for the specific language governing permissions and
+#   limitations under the License.
+
+"""
+Compact encoding for cached identities and sessions.
+
+Payload is a 0xC1 marker (never produced by msgpack, JSON or pickle), format version, flags byte and
+msgpack body. Well-known field names are replaced by small integers, with SERIALIZER_COMPRESS_MIN_SIZE
+bodies over that size are zlib-compressed. Values written before (JSON identities, pickled sessions) are still read.
+"""
+
+import pickle
+import zlib
+from json import loads as json_loads
+
+import msgpack
+
+from auth.config import Config
+
+MARKER = b"\xc1"
+VERSION = 1
+FLAG_ZLIB = 0x01
+
+# Append only: position is the wire code of a field name
+FIELDS = (
+    "username", "groups", "exp", "name", "auth", "auth_attributes", "auth_errors", "auth_nameid",
+    "auth_sessionindex", "preferred_username", "email", "state", "nonce", "id_token_hint", "_permanent",
+    "X-Forwarded-Proto", "X-Forwarded-Host", "X-Forwarded-Port", "X-Forwarded-Uri", "login_id",
+)
+FIELD_CODES = {field: code for code, field in enumerate(FIELDS)}
+
+
+def _shorten(obj):
+    """ Dict keys only, lists (such as groups) are left as they are, unknown keys stay strings """
+    if isinstance(obj, dict):
+        return {FIELD_CODES.get(key, key): _shorten(value) for key, value in obj.items()}
+    return obj
+
+
+def _expand(pairs):
+    return {FIELDS[key] if isinstance(key, int) else key: value for key, value in pairs}
+
+
+def dumps(obj) -> bytes:
+    body = msgpack.packb(_shorten(obj), use_bin_type=True)
+    flags = 0
+    if 0 < Config.SERIALIZER_COMPRESS_MIN_SIZE <= len(body):
+        body = zlib.compress(body, 1)  # Fastest level, decompressed on every read
+        flags |= FLAG_ZLIB
+    return MARKER + bytes((VERSION, flags)) + body
+
+
+def loads(data: bytes, legacy=json_loads):
+    """ Decode ``dumps`` output, anything else is handed to ``legacy`` """
+    if not data.startswith(MARKER):
+        return legacy(data)
+    version, flags = data[1], data[2]
+    if version != VERSION:
+        raise ValueError(f"Unsupported encoding version {version}")
+    body = data[3:]
+    if flags & FLAG_ZLIB:
+        body = zlib.decompress(body)
+    return msgpack.unpackb(body, raw=False, strict_map_key=False, object_pairs_hook=_expand)
+
+
+class SessionSerializer:
+    """ Flask-Session serializer, reads sessions pickled before the switch """
+
+    @staticmethod
+    def dumps(session) -> bytes:
+        return dumps(session)
+
+    @staticmethod
+    def loads(data: bytes):
+        return loads(data, legacy=pickle.loads)
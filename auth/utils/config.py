@@ -14,8 +14,10 @@
 
 import os
 import re
+from threading import Thread
+from time import monotonic, sleep
 
-import hvac  # pylint: disable=E0401
+SECRET_REFERENCE = re.compile(r"^\$\=\S*$")
 
 
 def config_substitution(obj, secrets):
@@ -31,7 +33,7 @@ def config_substitution(obj, secrets):
         if re.match(r"^\$\![a-zA-Z_][a-zA-Z0-9_]*$", obj.strip()) \
                 and obj.strip()[2:] in os.environ:
             return os.environ[obj.strip()[2:]]
-        if re.match(r"^\$\=\S*$", obj.strip()):
+        if SECRET_REFERENCE.match(obj.strip()):
             obj_key = obj.strip()[2:]
             obj_value = secrets.get(obj_key, None)
             if obj_value is not None:
@@ -39,10 +41,20 @@ def config_substitution(obj, secrets):
     return obj
 
 
+def uses_secrets(obj):
+    """ Settings reference at least one $=secret """
+    if isinstance(obj, dict):
+        return any(uses_secrets(key) or uses_secrets(value) for key, value in obj.items())
+    if isinstance(obj, list):
+        return any(uses_secrets(item) for item in obj)
+    return isinstance(obj, str) and bool(SECRET_REFERENCE.match(obj.strip()))
+
+
 def vault_secrets(settings):
-    """ Get secrets from HashiCorp Vault """
-    if "vault" not in settings:
+    """ Get secrets from HashiCorp Vault, skipped when settings have no $=secret references """
+    if "vault" not in settings or not uses_secrets({k: v for k, v in settings.items() if k != "vault"}):
         return dict()
+    import hvac  # pylint: disable=E0401
     config = settings["vault"]
     client = hvac.Client(
         url=config["url"],
@@ -65,3 +77,45 @@ def vault_secrets(settings):
         path=config.get("secrets_path", "secrets"),
         mount_point=config.get("secrets_mount_point", "kv")
     ).get("data", dict()).get("data", dict())
+
+
+class ConfigWatcher(Thread):
+    """
+    Calls ``reload`` when settings file changes (checked every ``watch_interval`` seconds)
+    and every ``vault_interval`` seconds, so rotated Vault secrets are picked up. 0 disables either check.
+    """
+
+    def __init__(self, filename, reload, logger, watch_interval=0, vault_interval=0):
+        super().__init__(name="config-watcher", daemon=True)
+        self.filename = filename
+        self.reload = reload
+        self.logger = logger
+        self.watch_interval = watch_interval
+        self.vault_interval = vault_interval
+
+    @property
+    def enabled(self):
+        return bool(self.filename) and (self.watch_interval > 0 or self.vault_interval > 0)
+
+    def _mtime(self):
+        try:
+            return os.stat(self.filename).st_mtime_ns
+        except OSError:
+            return None
+
+    def run(self):
+        intervals = [interval for interval in (self.watch_interval, self.vault_interval) if interval > 0]
+        mtime = self._mtime()
+        reloaded_at = monotonic()
+        while True:
+            sleep(min(intervals))
+            current_mtime = self._mtime() if self.watch_interval > 0 else mtime
+            vault_due = self.vault_interval > 0 and monotonic() - reloaded_at >= self.vault_interval
+            if current_mtime == mtime and not vault_due:
+                continue
+            mtime = current_mtime
+            reloaded_at = monotonic()
+            try:
+                self.reload()
+            except:  # pylint: disable=W0702
+                self.logger.exception("Configuration reload failed, keeping previous configuration")
@@ -0,0 +1,65 @@
+#   Copyright 2020 getcarrier.io
+#
+#   Licensed under the Apache License, Version 2.0 (the "License");
+#   you may not use this file except in compliance with the License.
+#   You may obtain a copy of the License at
+#
+#       http://www.apache.org/licenses/LICENSE-2.0
+#
+#   Unless required by applicable law or agreed to in writing, software
+#   distributed under the License is distributed on an "AS IS" BASIS,
+#   WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#   See the License for the specific language governing permissions and
+#   limitations under the License.
+
+from typing import Any, Callable, FrozenSet, Iterable, Optional
+
+from auth.config import Config
+from auth.utils.local_cache import LocalCache
+from auth.utils.metrics import cache_lookup
+
+
+def group_index(groups: Iterable[str], parents: bool = False) -> FrozenSet[str]:
+    """ Set of group paths, with ``parents`` every ancestor of a group ("/a/b" -> "/a") is included too """
+    index = set()
+    for group in groups or ():
+        index.add(group)
+        if parents:
+            parts = group.split("/")
+            for depth in range(2, len(parts)):
+                index.add("/".join(parts[:depth]))
+    return frozenset(index)
+
+
+class DecisionCache:
+    """
+    Per-login memo of mapper decisions, keyed by the login id stored in session at callback.
+
+    Identity in session does not change until next login, so a decision stays valid until
+    the login id is replaced or cleared.
+    """
+
+    def __init__(self, max_entries: int = 1024, ttl: float = 30):
+        self._logins = LocalCache(max_entries=max_entries, ttl=ttl)
+
+    def get(self, login_id: Optional[str], key: Any, compute: Callable[[], Any]) -> Any:
+        if not login_id:
+            return compute()
+        decisions = self._logins.get(login_id)
+        if decisions is None:
+            decisions = dict()
+            self._logins.set(login_id, decisions)
+        cache_lookup("decision", key in decisions)
+        if key not in decisions:
+            decisions[key] = compute()
+        return decisions[key]
+
+    def invalidate(self, login_id: Optional[str]) -> None:
+        if login_id:
+            self._logins.delete(login_id)
+
+    def clear(self) -> None:
+        self._logins.clear()
+
+
+decision_cache = DecisionCache(max_entries=Config.DECISION_CACHE_SIZE, ttl=Config.DECISION_CACHE_TTL)
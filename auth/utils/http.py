@@ -0,0 +1,56 @@
+#   Copyright 2020 getcarrier.io
+#
+#   Licensed under the Apache License, Version 2.0 (the "License");
+#   you may not use this file except in compliance with the License.
+#   You may obtain a copy of the License at
+#
+#       http://www.apache.org/licenses/LICENSE-2.0
+#
+#   Unless required by applicable law or agreed to in writing, software
+#   distributed under the License is distributed on an "AS IS" BASIS,
+#   WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#   See the License for the specific language governing permissions and
+#   limitations under the License.
+
+from requests import Session
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+
+
+class HttpSession(Session):
+    """
+    Keep-alive session with a sized connection pool, default timeouts and bounded retries.
+
+    Settings (all optional): pool_connections, pool_maxsize, connect_timeout, read_timeout,
+    retries, backoff_factor.
+    """
+
+    def __init__(self, settings=None):
+        super().__init__()
+        self.configure(settings)
+
+    def configure(self, settings=None):
+        settings = settings or dict()
+        self.timeout = (settings.get("connect_timeout", 3.05), settings.get("read_timeout", 10))
+        retry_kwargs = dict(
+            total=settings.get("retries", 2),
+            backoff_factor=settings.get("backoff_factor", 0.2),
+            status_forcelist=(502, 503, 504),
+            raise_on_status=False,
+        )
+        # Token grants are safe to repeat, allow retrying POST too
+        if hasattr(Retry, "DEFAULT_ALLOWED_METHODS"):
+            retry_kwargs["allowed_methods"] = None
+        else:
+            retry_kwargs["method_whitelist"] = False
+        adapter = HTTPAdapter(
+            pool_connections=settings.get("pool_connections", 10),
+            pool_maxsize=settings.get("pool_maxsize", 50),
+            max_retries=Retry(**retry_kwargs),
+        )
+        self.mount("http://", adapter)
+        self.mount("https://", adapter)
+
+    def request(self, method, url, **kwargs):  # pylint: disable=W0221
+        kwargs.setdefault("timeout", self.timeout)
+        return super().request(method, url, **kwargs)
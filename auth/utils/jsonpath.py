@@ -0,0 +1,62 @@
+#   Copyright 2020 getcarrier.io
+#
+#   Licensed under the Apache License, Version 2.0 (the "License");
+#   you may not use this file except in compliance with the License.
+#   You may obtain a copy of the License at
+#
+#       http://www.apache.org/licenses/LICENSE-2.0
+#
+#   Unless required by applicable law or agreed to in writing, software
+#   distributed under the License is distributed on an "AS IS" BASIS,
+#   WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#   See the License for the specific language governing permissions and
+#   limitations under the License.
+
+import re
+from functools import reduce
+from operator import getitem
+
+SIMPLE_PATH = re.compile(r"^'[^']*'(\.'[^']*')*$")
+SIMPLE_PATH_KEY = re.compile(r"'([^']*)'")
+BASE_CLAIMS = ("preferred_username", "groups", "exp")
+
+
+def compile_path(path):
+    """ Build a getter for path: plain key lookups for 'a'.'b' paths, compiled jsonpath otherwise """
+    if SIMPLE_PATH.match(path.strip()):
+        keys = SIMPLE_PATH_KEY.findall(path)
+        return lambda data: reduce(getitem, keys, data)
+    import jsonpath_rw
+    expression = jsonpath_rw.parse(path)
+    return lambda data: expression.find(data)[0].value
+
+
+def compile_mappers(mappers):
+    """ Turn mapper settings into {target: {scope: [(name, getter)]}} plans, done once at config load """
+    return {
+        target: {
+            scope: [(name, compile_path(path)) for name, path in (items or {}).items()]
+            for scope, items in scopes.items()
+        }
+        for target, scopes in mappers.items() if target in ("header", "json")
+    }
+
+
+def session_claims(mappers, extra=()):
+    """ ID token claims kept in session: used by /auth, /me and mappers, None keeps all of them """
+    claims = set(BASE_CLAIMS) | set(extra)
+    if "*" in claims:
+        return None
+    for target, scopes in mappers.items():
+        if target not in ("header", "json"):
+            continue
+        for items in scopes.values():
+            for path in (items or {}).values():
+                if not SIMPLE_PATH.match(path.strip()):
+                    return None  # Claims read by jsonpath expressions are not known upfront
+                keys = SIMPLE_PATH_KEY.findall(path)
+                if keys[0] == "auth_attributes":
+                    if len(keys) == 1:
+                        return None
+                    claims.add(keys[1])
+    return claims
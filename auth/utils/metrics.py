@@ -0,0 +1,87 @@
+#   Copyright 2020 getcarrier.io
+#
+#   Licensed under the Apache License, Version 2.0 (the "License");
+#   you may not use this file except in compliance with the License.
+#   You may obtain a copy of the License at
+#
+#       http://www.apache.org/licenses/LICENSE-2.0
+#
+#   Unless required by applicable law or agreed to in writing, software
+#   distributed under the License is distributed on an "AS IS" BASIS,
+#   WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#   See the License for the specific language governing permissions and
+#   limitations under the License.
+
+import os
+from contextlib import contextmanager
+from functools import wraps
+from time import perf_counter
+
+from flask import g, has_request_context
+from prometheus_client import CollectorRegistry, Counter, Gauge, Histogram, generate_latest, CONTENT_TYPE_LATEST
+from prometheus_client import multiprocess
+
+STAGE_SECONDS = Histogram(
+    "auth_stage_seconds", "Time spent in auth decision stages", ("stage",),
+    buckets=(.0005, .001, .0025, .005, .01, .025, .05, .1, .25, .5, 1, 2.5, 5, 10),
+)
+CACHE_LOOKUPS = Counter("auth_cache_lookups_total", "Token cache lookups", ("cache", "result"))
+VERDICTS = Counter("auth_verdicts_total", "Forward-auth decisions", ("outcome", "target"))
+REVOCATION_QUEUE_DEPTH = Gauge(
+    "auth_revocation_queue_depth", "Revocations waiting or in progress", multiprocess_mode="max"
+)
+REVOCATION_DEAD_LETTERS = Gauge(
+    "auth_revocation_dead_letters", "Revocations given up after retries", multiprocess_mode="max"
+)
+REVOCATIONS = Counter("auth_revocations_total", "Processed revocation attempts", ("result",))
+REVOCATION_LATENCY = Histogram(
+    "auth_revocation_latency_seconds", "Time from enqueue to completed revocation",
+    buckets=(.05, .1, .25, .5, 1, 2.5, 5, 10, 30, 60, 300),
+)
+STARTUP_SECONDS = Gauge("auth_startup_seconds", "Time spent in create_app", multiprocess_mode="max")
+
+
+def observe(stage, seconds):
+    STAGE_SECONDS.labels(stage).observe(seconds)
+    if has_request_context():
+        g.setdefault("server_timing", list()).append((stage, seconds))
+
+
+@contextmanager
+def timer(stage):
+    started = perf_counter()
+    try:
+        yield
+    finally:
+        observe(stage, perf_counter() - started)
+
+
+def timed(stage):
+    """ Decorator: record call duration as ``stage`` """
+    def decorator(func):
+        @wraps(func)
+        def wrapper(*args, **kwargs):
+            with timer(stage):
+                return func(*args, **kwargs)
+        return wrapper
+    return decorator
+
+
+def cache_lookup(cache, hit):
+    CACHE_LOOKUPS.labels(cache, "hit" if hit else "miss").inc()
+
+
+def server_timing_header():
+    """ Server-Timing value for stages recorded during current request """
+    return ", ".join(
+        f"{stage};dur={seconds * 1000:.3f}" for stage, seconds in g.get("server_timing", list())
+    )
+
+
+def export():
+    """ Metrics exposition, aggregated across gunicorn workers when prometheus_multiproc_dir is set """
+    if "prometheus_multiproc_dir" in os.environ:
+        registry = CollectorRegistry()
+        multiprocess.MultiProcessCollector(registry)
+        return generate_latest(registry), CONTENT_TYPE_LATEST
+    return generate_latest(), CONTENT_TYPE_LATEST
@@ -0,0 +1,68 @@
+#   Copyright 2020 getcarrier.io
+#
+#   Licensed under the Apache License, Version 2.0 (the "License");
+#   you may not use this file except in compliance with the License.
+#   You may obtain a copy of the License at
+#
+#       http://www.apache.org/licenses/LICENSE-2.0
+#
+#   Unless required by applicable law or agreed to in writing, software
+#   distributed under the License is distributed on an "AS IS" BASIS,
+#   WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#   See the License for the specific language governing permissions and
+#   limitations under the License.
+
+import base64
+from json import loads
+
+from flask import current_app, has_app_context
+
+DEFAULT_REALM = "default"
+
+
+def decode_id_token(id_token, segment=1):
+    segments = id_token.split('.')
+    if len(segments) != 3:
+        raise Exception('Wrong number of segments in token: %s' % id_token)
+    b64string = segments[segment]
+    padded = b64string + '=' * (-len(b64string) % 4)
+    padded = base64.urlsafe_b64decode(padded)
+    return loads(padded)
+
+
+def build_realms(oidc):
+    """
+    {realm: settings} and {issuer: realm} index from oidc settings.
+
+    Top-level issuer and registration are the default realm, entries of ``realms`` inherit
+    every top-level setting they do not override.
+    """
+    base = {key: value for key, value in (oidc or dict()).items() if key != "realms"}
+    realms = {DEFAULT_REALM: base}
+    for name, settings in ((oidc or dict()).get("realms") or dict()).items():
+        realms[name] = dict(base, **settings)
+    issuers = {settings["issuer"].rstrip("/"): name for name, settings in realms.items() if "issuer" in settings}
+    return realms, issuers
+
+
+def realm_settings(realm=DEFAULT_REALM):
+    return current_app.config["oidc_realms"][realm]
+
+
+def realm_for_token(token):
+    """ Realm of a JWT by its ``iss`` claim, default realm for unknown issuers and opaque tokens """
+    issuers = current_app.config.get("oidc_issuers") if has_app_context() else None
+    if not issuers or len(issuers) < 2:
+        return DEFAULT_REALM
+    try:
+        issuer = decode_id_token(token).get("iss", "")
+    except Exception:  # pylint: disable=W0703
+        return DEFAULT_REALM
+    return issuers.get(str(issuer).rstrip("/"), DEFAULT_REALM)
+
+
+def realm_for_header(auth_header):
+    auth_key, _, value = auth_header.strip().partition(" ")
+    if auth_key.lower() != "bearer":
+        return DEFAULT_REALM
+    return realm_for_token(value.strip())
@@ -13,45 +13,192 @@
 #   limitations under the License.
 
 import hashlib
-from typing import Optional
+from time import monotonic, time
+from typing import Dict, List, Optional, Tuple
 
 import redis
+from redis.lock import Lock
 
 from auth.config import Config
+from auth.utils.local_cache import LocalCache
+from auth.utils.metrics import cache_lookup, timed
+from auth.utils.realms import DEFAULT_REALM, realm_for_header
 
 
 class RedisClient:
     DEFAULT_VALUE = "1"
     DEFAULT_TTL = 60 * 10
+    # Token buckets: KEYS are bucket names, ARGV is now followed by (rate, burst) per key.
+    # Either every bucket gives a token or none is consumed.
+    TOKEN_BUCKET_SCRIPT = """
+        local now = tonumber(ARGV[1])
+        local granted = tonumber(ARGV[2])
+        local levels = {}
+        for i, key in ipairs(KEYS) do
+            local rate = tonumber(ARGV[i * 2 + 1])
+            local burst = tonumber(ARGV[i * 2 + 2])
+            local bucket = redis.call("HMGET", key, "tokens", "ts")
+            local tokens = tonumber(bucket[1]) or burst
+            local ts = tonumber(bucket[2]) or now
+            levels[i] = math.min(burst, tokens + math.max(0, now - ts) * rate)
+            granted = math.min(granted, math.floor(levels[i]))
+            if granted < 1 then
+                return 0
+            end
+        end
+        for i, key in ipairs(KEYS) do
+            local rate = tonumber(ARGV[i * 2 + 1])
+            local burst = tonumber(ARGV[i * 2 + 2])
+            redis.call("HMSET", key, "tokens", levels[i] - granted, "ts", now)
+            redis.call("EXPIRE", key, math.ceil(burst / rate) + 1)
+        end
+        return granted
+    """
+    # Process-local L1 in front of Redis, entries never outlive the Redis key
+    local_cache = LocalCache(max_entries=Config.LOCAL_CACHE_SIZE, ttl=Config.LOCAL_CACHE_TTL)
 
     def __init__(self):
-        self._rc = redis.Redis(
-            host=Config.REDIS_HOST,
-            port=Config.REDIS_PORT,
-            db=Config.REDIS_DB,
-            password=Config.REDIS_PASSWORD,
-            username=Config.REDIS_USER
+        self._rc = redis.Redis(connection_pool=Config.REDIS_POOL)
+        self._replica = redis.Redis(connection_pool=Config.REDIS_REPLICA_POOL)
+
+    @staticmethod
+    def key(auth_header: str) -> str:
+        """ Cache key of credentials, namespaced by OIDC realm unless it is the default one """
+        digest = hashlib.sha256(auth_header.encode()).hexdigest()
+        realm = realm_for_header(auth_header)
+        return digest if realm == DEFAULT_REALM else f"{realm}:{digest}"
+
+    def ping(self) -> bool:
+        return self._rc.ping()
+
+    def lock(self, key_hex: str) -> Lock:
+        """
+        Short-lived cross-worker lock guarding upstream validation of ``key_hex``.
+        """
+        return self._rc.lock(
+            f"lock:{key_hex}", timeout=Config.AUTH_LOCK_TIMEOUT, blocking_timeout=Config.AUTH_LOCK_WAIT
         )
 
-    def check_auth_token(self, auth_header: str) -> bool:
-        key_hex = hashlib.sha256(auth_header.encode()).hexdigest()
-        return self._rc.exists(key_hex)
+    def set_rejected(self, key_hex: str, ttl: Optional[int] = None) -> None:
+        """
+        Remember credentials refused by the IdP for ``ttl`` seconds, dropping any cached identity.
+        """
+        if ttl is None:
+            ttl = Config.NEGATIVE_CACHE_TTL
+        self.local_cache.delete(key_hex)
+        pipe = self._rc.pipeline(transaction=False)
+        pipe.delete(key_hex)
+        if ttl > 0:
+            pipe.set(name=f"rejected:{key_hex}", value=self.DEFAULT_VALUE, ex=ttl)
+        pipe.execute()
+
+    @timed("redis_rate_limit")
+    def consume(self, buckets: Dict[str, Tuple[float, float]], cost: int = 1) -> int:
+        """
+        Take up to ``cost`` tokens from each of ``buckets`` ({name: (rate per second, burst)}).
+        Returns how many were taken, as many as fit in the emptiest bucket: 0 when any is empty.
+        """
+        buckets = {name: limits for name, limits in buckets.items() if limits[0] > 0}
+        if not buckets:
+            return cost
+        args = [time(), cost]
+        for rate, burst in buckets.values():
+            args.extend((rate, burst))
+        script = self._rc.register_script(self.TOKEN_BUCKET_SCRIPT)
+        return int(script(keys=[f"ratelimit:{name}" for name in buckets], args=args))
+
+    @timed("redis_lookup")
+    def lookup(self, key_hex: str, local: bool = True,
+               primary: bool = False) -> Tuple[Optional[bytes], bool, Optional[float]]:
+        """
+        Cached identity, negative verdict and seconds left in Redis for ``key_hex``, in at most one round trip.
+
+        The local copy remembers the Redis deadline, so it never outlives the Redis key.
+        Redis is read from replicas unless ``primary`` is set.
+        """
+        entry = self.local_cache.get(key_hex) if local else None
+        cache_lookup("local", entry is not None)
+        if entry is not None:
+            value, deadline = entry
+            return value, False, None if deadline is None else deadline - monotonic()
+        pipe = (self._rc if primary else self._replica).pipeline(transaction=False)
+        pipe.get(key_hex)
+        pipe.pttl(key_hex)
+        pipe.exists(f"rejected:{key_hex}")
+        value, pttl, rejected = pipe.execute()
+        cache_lookup("redis", value is not None)
+        if value is not None:
+            ttl_left = pttl / 1000 if pttl >= 0 else None
+            self._remember(key_hex, value, ttl_left)
+            return value, False, ttl_left
+        cache_lookup("negative", bool(rejected))
+        return None, bool(rejected), None
 
-    def get_auth_token(self, auth_header: str) -> Optional[str]:
-        key_hex = hashlib.sha256(auth_header.encode()).hexdigest()
-        return self._rc.get(name=key_hex)
+    @timed("redis_lookup_many")
+    def lookup_many(self, keys_hex: List[str]) -> Dict[str, Tuple[Optional[bytes], bool, Optional[float]]]:
+        """
+        ``lookup`` for many keys, local cache first and one pipelined round trip for the rest.
+        """
+        results = dict()
+        misses = list()
+        for key_hex in dict.fromkeys(keys_hex):
+            entry = self.local_cache.get(key_hex)
+            cache_lookup("local", entry is not None)
+            if entry is None:
+                misses.append(key_hex)
+                continue
+            value, deadline = entry
+            results[key_hex] = (value, False, None if deadline is None else deadline - monotonic())
+        if not misses:
+            return results
+        pipe = self._replica.pipeline(transaction=False)
+        pipe.mget(misses)
+        pipe.mget([f"rejected:{key_hex}" for key_hex in misses])
+        for key_hex in misses:
+            pipe.pttl(key_hex)
+        values, rejected, *pttls = pipe.execute()
+        for key_hex, value, is_rejected, pttl in zip(misses, values, rejected, pttls):
+            cache_lookup("redis", value is not None)
+            if value is not None:
+                ttl_left = pttl / 1000 if pttl >= 0 else None
+                self._remember(key_hex, value, ttl_left)
+                results[key_hex] = (value, False, ttl_left)
+                continue
+            cache_lookup("negative", is_rejected is not None)
+            results[key_hex] = (None, is_rejected is not None, None)
+        return results
 
-    def clear_auth_token(self, auth_header: str) -> Optional[str]:
-        key_hex = hashlib.sha256(auth_header.encode()).hexdigest()
+    def _remember(self, key_hex: str, value: bytes, ttl: Optional[float]) -> None:
+        deadline = None if ttl is None else monotonic() + ttl
+        self.local_cache.set(key_hex, (value, deadline), ttl=ttl)
+
+    def get_auth_token(self, key_hex: str) -> Optional[bytes]:
+        return self.lookup(key_hex)[0]
+
+    @timed("redis_delete")
+    def clear_auth_token(self, key_hex: str) -> Optional[int]:
+        self.local_cache.delete(key_hex)
         return self._rc.delete(key_hex)
 
-    def set_auth_token(self, auth_header: str, value: Optional[str] = None, ttl: Optional[int] = None) -> None:
+    @timed("redis_set")
+    def set_auth_token(self, key_hex: str, value: Optional[str] = None, ttl: Optional[int] = None) -> None:
         """
         ``ttl`` sets an expire flag on key for ``ttl`` seconds.
         """
-        key_hex = hashlib.sha256(auth_header.encode()).hexdigest()
         if value is None:
             value = self.DEFAULT_VALUE
         if ttl is None:
             ttl = self.DEFAULT_TTL
-        return self._rc.set(name=key_hex, value=value, ex=ttl)
+        pipe = self._rc.pipeline(transaction=False)
+        pipe.set(name=key_hex, value=value, ex=ttl)
+        pipe.delete(f"rejected:{key_hex}")
+        pipe.execute()
+        self._remember(key_hex, value.encode() if isinstance(value, str) else value, ttl)
+
+    @timed("redis_expire")
+    def touch_auth_token(self, key_hex: str, value: bytes, ttl: int) -> None:
+        """
+        Slide expiry of a cached identity to ``ttl`` seconds from now.
+        """
+        if self._rc.expire(key_hex, ttl):
+            self._remember(key_hex, value, ttl)
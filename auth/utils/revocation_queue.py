@@ -0,0 +1,151 @@
+#   Copyright 2020 getcarrier.io
+#
+#   Licensed under the Apache License, Version 2.0 (the "License");
+#   you may not use this file except in compliance with the License.
+#   You may obtain a copy of the License at
+#
+#       http://www.apache.org/licenses/LICENSE-2.0
+#
+#   Unless required by applicable law or agreed to in writing, software
+#   distributed under the License is distributed on an "AS IS" BASIS,
+#   WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#   See the License for the specific language governing permissions and
+#   limitations under the License.
+
+import hashlib
+from json import dumps, loads
+from threading import Thread
+from time import sleep, time
+from typing import Callable, List
+
+import redis
+
+from auth.config import Config
+from auth.utils.metrics import REVOCATION_DEAD_LETTERS, REVOCATION_LATENCY, REVOCATION_QUEUE_DEPTH, REVOCATIONS
+
+
+class RevocationQueue:
+    """
+    Durable queue of refresh tokens to revoke, drained by background workers.
+
+    Items live in a sorted set scored by the time they are due. Claiming a batch moves their score
+    ``lease`` seconds ahead, so items of a crashed worker come back once the lease runs out.
+    Failed items are retried with exponential backoff, after ``max_attempts`` they go to a capped dead-letter list,
+    with the token replaced by its SHA-256 digest: it is still valid, revocation failed.
+    At most ``max_pending`` items wait in the queue, ``enqueue`` refuses more.
+    """
+
+    PENDING = "revocations:pending"
+    DEAD = "revocations:dead"
+    # KEYS[1] pending set, ARGV: item, now, max pending
+    ENQUEUE_SCRIPT = """
+        if redis.call("ZCARD", KEYS[1]) >= tonumber(ARGV[3]) then
+            return 0
+        end
+        redis.call("ZADD", KEYS[1], tonumber(ARGV[2]), ARGV[1])
+        return 1
+    """
+    # KEYS[1] pending set, ARGV: now, batch size, lease seconds
+    CLAIM_SCRIPT = """
+        local items = redis.call("ZRANGEBYSCORE", KEYS[1], "-inf", ARGV[1], "LIMIT", 0, tonumber(ARGV[2]))
+        for _, item in ipairs(items) do
+            redis.call("ZADD", KEYS[1], tonumber(ARGV[1]) + tonumber(ARGV[3]), item)
+        end
+        return items
+    """
+
+    def __init__(self, batch_size: int = 20, lease: float = 60, max_attempts: int = 5,
+                 backoff: float = 1, dead_letter_size: int = 10000, max_pending: int = 100000):
+        self.batch_size = batch_size
+        self.lease = lease
+        self.max_attempts = max_attempts
+        self.backoff = backoff
+        self.dead_letter_size = dead_letter_size
+        self.max_pending = max_pending
+        self._rc = redis.Redis(connection_pool=Config.REDIS_POOL)
+        self._workers = list()
+
+    def enqueue(self, token: str) -> bool:
+        """ Queue ``token`` for revocation, False when the queue is full """
+        item = dumps({"token": token, "attempts": 0, "enqueued": time()})
+        script = self._rc.register_script(self.ENQUEUE_SCRIPT)
+        return bool(script(keys=[self.PENDING], args=[item, time(), self.max_pending]))
+
+    def claim(self) -> List[str]:
+        script = self._rc.register_script(self.CLAIM_SCRIPT)
+        return [item.decode() for item in script(keys=[self.PENDING], args=[time(), self.batch_size, self.lease])]
+
+    def complete(self, done: List[str], failed: List[str]) -> None:
+        """ Remove ``done`` items, reschedule or dead-letter ``failed`` ones, in one round trip """
+        now = time()
+        pipe = self._rc.pipeline(transaction=False)
+        if done:
+            pipe.zrem(self.PENDING, *done)
+        for raw in failed:
+            item = loads(raw)
+            item["attempts"] += 1
+            pipe.zrem(self.PENDING, raw)
+            if item["attempts"] >= self.max_attempts:
+                token = item.pop("token")
+                item["token_sha256"] = hashlib.sha256(token.encode()).hexdigest()
+                pipe.lpush(self.DEAD, dumps(dict(item, failed=now)))
+                pipe.ltrim(self.DEAD, 0, self.dead_letter_size - 1)
+                REVOCATIONS.labels("dead").inc()
+            else:
+                pipe.zadd(self.PENDING, {dumps(item): now + self.backoff * 2 ** (item["attempts"] - 1)})
+                REVOCATIONS.labels("retry").inc()
+        pipe.zcard(self.PENDING)
+        pipe.llen(self.DEAD)
+        *_, depth, dead = pipe.execute()
+        REVOCATION_QUEUE_DEPTH.set(depth)
+        REVOCATION_DEAD_LETTERS.set(dead)
+        for raw in done:
+            REVOCATIONS.labels("done").inc()
+            REVOCATION_LATENCY.observe(now - loads(raw)["enqueued"])
+
+    def drain(self, revoke: Callable[[str], bool]) -> int:
+        """ Process one batch with ``revoke(token) -> bool``, returns number of claimed items """
+        items = self.claim()
+        done, failed = list(), list()
+        for raw in items:
+            try:
+                ok = revoke(loads(raw)["token"])
+            except:  # pylint: disable=W0702
+                ok = False
+            (done if ok else failed).append(raw)
+        if items:
+            self.complete(done, failed)
+        else:
+            REVOCATION_QUEUE_DEPTH.set(self._rc.zcard(self.PENDING))
+        return len(items)
+
+    def _run(self, app, revoke, poll_interval):
+        while True:
+            try:
+                with app.app_context():
+                    claimed = self.drain(revoke)
+            except:  # pylint: disable=W0702
+                app.logger.exception("Revocation queue is not available")
+                claimed = 0
+            if claimed < self.batch_size:
+                sleep(poll_interval)
+
+    def start(self, app, revoke: Callable[[str], bool], workers: int = 2, poll_interval: float = 1) -> None:
+        """ Start ``workers`` daemon threads draining the queue, once per process """
+        if self._workers:
+            return
+        for index in range(workers):
+            worker = Thread(
+                target=self._run, args=(app, revoke, poll_interval), daemon=True, name=f"revocation-{index}"
+            )
+            worker.start()
+            self._workers.append(worker)
+
+
+revocation_queue = RevocationQueue(
+    batch_size=Config.REVOCATION_BATCH_SIZE,
+    lease=Config.REVOCATION_LEASE,
+    max_attempts=Config.REVOCATION_MAX_ATTEMPTS,
+    backoff=Config.REVOCATION_BACKOFF,
+    max_pending=Config.REVOCATION_MAX_PENDING,
+)
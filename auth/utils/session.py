@@ -12,8 +12,41 @@
 #   See the License for the specific language governing permissions and
 #   limitations under the License.
 
+from cryptography.fernet import Fernet, InvalidToken
+from flask.sessions import SecureCookieSessionInterface
+from flask_session.sessions import RedisSessionInterface as FlaskRedisSessionInterface, total_seconds
+from itsdangerous import BadSignature, URLSafeTimedSerializer, want_bytes
+
+from auth.utils.codec import SessionSerializer
+from auth.utils.decision_cache import decision_cache
+
+
+FORWARDED_HEADERS = ("X-Forwarded-Proto", "X-Forwarded-Host", "X-Forwarded-Port", "X-Forwarded-Uri")
+
+
+def _location_serializer(app):
+    return URLSafeTimedSerializer(app.secret_key, salt="forwarded-location")
+
+
+def sign_location(app, location):
+    """ Original request location as a signed token, carried through login redirects instead of a session """
+    return _location_serializer(app).dumps(location)
+
+
+def load_location(app, token, max_age=600):
+    """ Location from ``sign_location`` token, empty when missing, tampered or expired """
+    if not token:
+        return dict()
+    try:
+        location = _location_serializer(app).loads(token, max_age=max_age)
+    except BadSignature:
+        return dict()
+    return {header: str(value) for header, value in location.items() if header in FORWARDED_HEADERS}
+
 
 def clear_session(session):
+    decision_cache.invalidate(session.get("login_id"))
+    session["login_id"] = ""
     session["name"] = "auth"
     session["state"] = ""
     session["nonce"] = ""
@@ -22,3 +55,145 @@ def clear_session(session):
     session["auth_nameid"] = ""
     session["auth_sessionindex"] = ""
     session["auth_attributes"] = ""
+    session["id_token_hint"] = ""
+
+
+class _EncryptedSerializer:
+    """ Encrypt signed session payload with Fernet, which also authenticates it """
+
+    def __init__(self, serializer, fernet):
+        self.serializer = serializer
+        self.fernet = fernet
+
+    def dumps(self, value):
+        return self.fernet.encrypt(self.serializer.dumps(value).encode()).decode()
+
+    def loads(self, value, max_age=None):
+        try:
+            value = self.fernet.decrypt(value.encode() if isinstance(value, str) else value).decode()
+        except InvalidToken:
+            raise BadSignature("Session cookie can not be decrypted")
+        return self.serializer.loads(value, max_age=max_age)
+
+
+class CookieSessionInterface(SecureCookieSessionInterface):
+    """
+    Stateless sessions: identity is carried in a signed (and optionally encrypted) cookie,
+    so checking it needs no Redis round trip.
+
+    Encryption key is taken from SESSION_COOKIE_ENCRYPTION_KEY app config. Once logged in, login-only
+    keys are dropped from the cookie. A cookie still over MAX_COOKIE_SIZE is an error: browsers
+    silently drop it and send the user back to login.
+    """
+
+    # Needed by login callback only, ID token hint repeats the claims already in auth_attributes
+    LOGIN_ONLY_KEYS = ("id_token_hint", "state", "nonce")
+
+    def __init__(self):
+        self._fernet = (None, None)
+
+    def save_session(self, app, session, response):
+        if session.get("auth"):
+            for key in self.LOGIN_ONLY_KEYS:
+                if key in session:
+                    del session[key]
+        super().save_session(app, session, response)
+        prefix = f"{app.session_cookie_name}="
+        for cookie in response.headers.getlist("Set-Cookie"):
+            if cookie.startswith(prefix) and len(cookie) > response.max_cookie_size:
+                raise ValueError(
+                    f"Session cookie is {len(cookie)} bytes, over {response.max_cookie_size} browsers accept. "
+                    "Trim global.session_claims or use SESSION_TYPE=redis"
+                )
+
+    def get_fernet(self, app):
+        key = app.config.get("SESSION_COOKIE_ENCRYPTION_KEY")
+        if self._fernet[0] != key:
+            self._fernet = (key, Fernet(key) if key else None)
+        return self._fernet[1]
+
+    def get_signing_serializer(self, app):
+        serializer = super().get_signing_serializer(app)
+        fernet = self.get_fernet(app)
+        if serializer is None or fernet is None:
+            return serializer
+        return _EncryptedSerializer(serializer, fernet)
+
+
+class RedisSessionInterface(FlaskRedisSessionInterface):
+    """
+    Flask-Session Redis sessions in compact encoding.
+
+    Requests with Authorization header to ``stateless_paths`` get an empty session that is never stored.
+    Sessions for ``replica_paths`` (read-mostly forward-auth checks) are loaded from ``replica``, falling
+    back to the primary for sessions not replicated yet or not logged in there yet. New sessions are stored
+    only once something is written to them, unchanged stored sessions only get their expiry extended, and
+    changes to a replica read are dropped when the primary already holds a different session, so a stale
+    replica read is never written back over a newer session.
+    """
+
+    serializer = SessionSerializer()
+
+    def __init__(self, redis, replica=None, key_prefix="session:", use_signer=False, permanent=True,
+                 replica_paths=(), stateless_paths=()):
+        super().__init__(redis, key_prefix, use_signer, permanent)
+        self.replica = replica if replica is not None else redis
+        self.replica_paths = frozenset(replica_paths)
+        self.stateless_paths = frozenset(stateless_paths)
+
+    def open_session(self, app, request):
+        if "Authorization" in request.headers and request.path in self.stateless_paths:
+            session = self.session_class(sid=self._generate_sid(), permanent=self.permanent)
+            session.stateless = True
+            return session
+        sid = request.cookies.get(app.session_cookie_name)
+        if sid and self.use_signer:
+            try:
+                sid = self._get_signer(app).unsign(sid).decode()
+            except BadSignature:
+                sid = None
+        if not sid:
+            return self.session_class(sid=self._generate_sid(), permanent=self.permanent)
+        client = self.replica if request.path in self.replica_paths else self.redis
+        val = client.get(self.key_prefix + sid)
+        data = self._decode(val)
+        if client is not self.redis and not (isinstance(data, dict) and data.get("auth")):
+            # Replica may not have caught up with a login yet, only logged in sessions are taken from it
+            client = self.redis
+            val = client.get(self.key_prefix + sid)
+            data = self._decode(val)
+        if data is None:
+            return self.session_class(sid=sid, permanent=self.permanent)
+        session = self.session_class(data, sid=sid)
+        session.stored = True
+        if client is not self.redis:
+            session.replica_value = val
+        return session
+
+    def _decode(self, val):
+        if val is None:
+            return None
+        try:
+            return self.serializer.loads(val)
+        except:  # pylint: disable=W0702
+            return None
+
+    def save_session(self, app, session, response):
+        if getattr(session, "stateless", False):
+            return
+        replica_value = getattr(session, "replica_value", None)
+        if replica_value is not None and session.modified and \
+                self.redis.get(self.key_prefix + session.sid) not in (None, replica_value):
+            return  # Replica was behind, keep the newer session
+        if not session or session.modified:
+            super().save_session(app, session, response)
+            return
+        if not getattr(session, "stored", False):
+            return  # Nothing to keep yet, login stores the session
+        self.redis.expire(self.key_prefix + session.sid, total_seconds(app.permanent_session_lifetime))
+        session_id = self._get_signer(app).sign(want_bytes(session.sid)) if self.use_signer else session.sid
+        response.set_cookie(
+            app.session_cookie_name, session_id,
+            expires=self.get_expiration_time(app, session), httponly=self.get_cookie_httponly(app),
+            domain=self.get_cookie_domain(app), path=self.get_cookie_path(app), secure=self.get_cookie_secure(app),
+        )
@@ -0,0 +1,321 @@
+#   Copyright 2020 getcarrier.io
+#
+#   Licensed under the Apache License, Version 2.0 (the "License");
+#   you may not use this file except in compliance with the License.
+#   You may obtain a copy of the License at
+#
+#       http://www.apache.org/licenses/LICENSE-2.0
+#
+#   Unless required by applicable law or agreed to in writing, software
+#   distributed under the License is distributed on an "AS IS" BASIS,
+#   WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#   See the License for the specific language governing permissions and
+#   limitations under the License.
+
+"""
+Offline micro-benchmarks for the forward-auth hot paths.
+
+Runs the app in-process against a local fake OIDC issuer and fakeredis (or a Redis given with
+--redis-url) and reports requests/sec and p50/p99 latency per scenario as JSON:
+
+    python benchmarks/bench_forward_auth.py --output bench.json
+    python benchmarks/bench_forward_auth.py --compare bench.json  # exit code 1 on regression
+    python benchmarks/bench_forward_auth.py --startup-budget 1.5  # exit code 1 on slow cold start
+"""
+
+import argparse
+import base64
+import json
+import os
+import platform
+import subprocess
+import sys
+import tempfile
+from statistics import mean
+from time import perf_counter, time
+from urllib.parse import parse_qs, urlparse
+
+import yaml
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from benchmarks.fake_issuer import FakeIssuer  # pylint: disable=C0413
+
+CLIENT_ID = "bench"
+SCOPE_GROUPS = ["/grafana", "/galloper"]
+
+
+def write_settings(issuer):
+    settings = {
+        "global": {"debug": False, "disable_auth": False},
+        "endpoints": {
+            "root": "/forward-auth",
+            "oidc": "/forward-auth/oidc",
+            "info": "/forward-auth/info",
+            "access_denied": "/access_denied",
+        },
+        "auth": {
+            "auth_redirect": "http://localhost/forward-auth/login",
+            "login_handler": "http://localhost/forward-auth/oidc/login",
+            "token_handler": "http://localhost/forward-auth/oidc/token",
+            "logout_handler": "http://localhost/forward-auth/oidc/logout",
+            "login_default_redirect_url": "http://localhost/",
+            "logout_default_redirect_url": "http://localhost/",
+            "logout_allowed_redirect_urls": ["http://localhost/"],
+        },
+        "mappers": {
+            "header": {"grafana": {
+                "X-WEBAUTH-USER": "'auth_attributes'.'preferred_username'",
+                "X-WEBAUTH-NAME": "'auth_attributes'.'name'",
+                "X-WEBAUTH-EMAIL": "'auth_attributes'.'email'",
+            }},
+            "json": {"galloper": {
+                "login": "'auth_attributes'.'preferred_username'",
+                "name": "'auth_attributes'.'name'",
+                "email": "'auth_attributes'.'email'",
+            }},
+        },
+        "oidc": {
+            "debug": False,
+            "issuer": issuer.issuer,
+            "registration": {
+                "client_id": CLIENT_ID,
+                "client_secret": "secret",
+                "redirect_uris": ["http://localhost/forward-auth/oidc"],
+            },
+        },
+    }
+    fd, path = tempfile.mkstemp(suffix=".yaml")
+    with os.fdopen(fd, "w") as file:
+        yaml.safe_dump(settings, file)
+    return path
+
+
+def make_app(issuer, redis_url=None):
+    os.environ["CONFIG_FILENAME"] = write_settings(issuer)
+    if redis_url:
+        os.environ["SESSION_REDIS"] = redis_url
+    import redis
+    from auth.config import Config
+    if not redis_url:
+        import fakeredis  # pylint: disable=E0401
+        Config.REDIS_POOL = redis.ConnectionPool(
+            server=fakeredis.FakeServer(), connection_class=fakeredis.FakeConnection
+        )
+        Config.REDIS_REPLICA_POOL = Config.REDIS_POOL
+        Config.SESSION_REDIS = Config.SESSION_REDIS_REPLICA = redis.Redis(connection_pool=Config.REDIS_POOL)
+    # Benchmarks hammer a single client, limits would turn cold paths into 429s
+    Config.RATE_LIMIT_CREDENTIAL = (0, 0)
+    Config.RATE_LIMIT_CLIENT = (0, 0)
+    from auth.app import create_app
+    return create_app()
+
+
+def login_session(client, issuer):
+    now = int(time())
+    with client.session_transaction() as session:
+        session["name"] = "auth"
+        session["auth"] = True
+        session["auth_errors"] = []
+        session["auth_nameid"] = ""
+        session["auth_sessionindex"] = ""
+        session["login_id"] = "bench"
+        session["auth_attributes"] = {
+            "iss": issuer.issuer, "exp": now + 3600, "iat": now,
+            "preferred_username": "bench", "name": "bench", "email": "bench@example.com",
+            "groups": SCOPE_GROUPS,
+        }
+
+
+def expect(response, status):
+    if response.status_code != status:
+        raise AssertionError(f"Expected {status}, got {response.status_code}: {response.data[:200]}")
+    return response
+
+
+def build_scenarios(app, issuer, iterations):
+    """ {name: (setup, step)}, setup prepares state and returns the per-iteration callable """
+    basic = "Basic " + base64.b64encode(b"bench:password").decode()
+
+    def session_request(path, status=200):
+        def setup():
+            client = app.test_client()
+            login_session(client, issuer)
+            return lambda i: expect(client.get(path), status)
+        return setup
+
+    def header_request(path, header, status=200):
+        def setup():
+            client = app.test_client()
+            return lambda i: expect(client.get(path, headers={"Authorization": header}), status)
+        return setup
+
+    def cold_bearer(local):
+        def setup():
+            app.config["oidc_realms"]["default"]["local_token_verification"] = local  # Read per realm
+            typ = "Bearer" if local else "Refresh"
+            tokens = [f"Bearer {issuer.token(typ=typ)}" for _ in range(iterations)]
+            client = app.test_client()
+            return lambda i: expect(client.get("/forward-auth/auth", headers={"Authorization": tokens[i]}), 200)
+        return setup
+
+    def callback():
+        client = app.test_client()
+
+        def step(i):
+            location = urlparse(expect(client.get("/forward-auth/oidc/login"), 302).headers["Location"])
+            query = parse_qs(location.query)
+            code = f"code-{i}-{query['state'][0]}"
+            issuer.codes[code] = query["nonce"][0]
+            expect(client.get(f"/forward-auth/oidc/callback?code={code}&state={query['state'][0]}"), 302)
+        return step
+
+    cached_bearer = f"Bearer {issuer.token(typ='Refresh', ttl=86400)}"
+    return {
+        "auth_session_cookie": session_request("/forward-auth/auth"),
+        "auth_cached_basic": header_request("/forward-auth/auth", basic),
+        "auth_cached_bearer": header_request("/forward-auth/auth", cached_bearer),
+        "auth_cold_bearer_grant": cold_bearer(local=False),
+        "auth_cold_bearer_jwks": cold_bearer(local=True),
+        "auth_mapper_raw": session_request("/forward-auth/auth?target=raw"),
+        "auth_mapper_header": session_request("/forward-auth/auth?target=header&scope=grafana"),
+        "auth_mapper_json": session_request("/forward-auth/auth?target=json&scope=galloper"),
+        "me_session": session_request("/forward-auth/me"),
+        "me_token": header_request("/forward-auth/me", basic),
+        "oidc_callback": callback,
+    }
+
+
+STARTUP_PROBE = """
+import json, sys
+from time import perf_counter
+started = perf_counter()
+from auth.app import create_app
+imported = perf_counter()
+create_app()
+print(json.dumps([imported - started, perf_counter() - imported]))
+"""
+
+
+def measure_startup(runs):
+    """ Cold import and create_app time in fresh interpreters, settings come from CONFIG_FILENAME """
+    root = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+    env = dict(os.environ, PYTHONPATH=root)
+    samples = [
+        json.loads(subprocess.check_output([sys.executable, "-c", STARTUP_PROBE], env=env, cwd=root).splitlines()[-1])
+        for _ in range(runs)
+    ]
+    results = dict()
+    for index, name in enumerate(("startup_import", "startup_create_app")):
+        stage = sorted(sample[index] for sample in samples)
+        results[name] = {
+            "iterations": runs,
+            "mean_ms": round(mean(stage) * 1000, 3),
+            "p50_ms": round(stage[int(round(0.50 * (runs - 1)))] * 1000, 3),
+            "p99_ms": round(stage[int(round(0.99 * (runs - 1)))] * 1000, 3),
+        }
+    return results
+
+
+def measure(step, iterations, warmup):
+    for i in range(warmup):
+        step(i % iterations)
+    samples = []
+    started = perf_counter()
+    for i in range(iterations):
+        begin = perf_counter()
+        step(i)
+        samples.append(perf_counter() - begin)
+    elapsed = perf_counter() - started
+    samples.sort()
+    return {
+        "iterations": iterations,
+        "rps": round(iterations / elapsed, 1),
+        "mean_ms": round(mean(samples) * 1000, 3),
+        "p50_ms": round(samples[int(round(0.50 * (iterations - 1)))] * 1000, 3),
+        "p99_ms": round(samples[int(round(0.99 * (iterations - 1)))] * 1000, 3),
+    }
+
+
+def compare(results, baseline, tolerance):
+    """ Print p50/p99 changes against baseline, return names of regressed scenarios """
+    regressions = []
+    for name, current in results["scenarios"].items():
+        previous = baseline.get("scenarios", dict()).get(name)
+        if previous is None:
+            continue
+        for metric in ("p50_ms", "p99_ms"):
+            change = current[metric] / previous[metric] - 1 if previous[metric] else 0
+            print(f"{name:28} {metric} {previous[metric]:9.3f} -> {current[metric]:9.3f} ({change:+.1%})",
+                  file=sys.stderr)
+            if change > tolerance and name not in regressions:
+                regressions.append(name)
+    return regressions
+
+
+def git_revision():
+    try:
+        return subprocess.check_output(["git", "rev-parse", "HEAD"], stderr=subprocess.DEVNULL).decode().strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Forward-auth hot path benchmarks")
+    parser.add_argument("--iterations", type=int, default=1000)
+    parser.add_argument("--warmup", type=int, default=50)
+    parser.add_argument("--scenario", action="append", help="Run only given scenario, may be repeated")
+    parser.add_argument("--redis-url", help="Use a real Redis instead of fakeredis")
+    parser.add_argument("--output", help="Write results JSON to file instead of stdout")
+    parser.add_argument("--compare", help="Baseline results JSON to compare with")
+    parser.add_argument("--tolerance", type=float, default=0.2, help="Allowed relative latency increase")
+    parser.add_argument("--startup-runs", type=int, default=5, help="Fresh interpreters for startup timing, 0 skips")
+    parser.add_argument("--startup-budget", type=float,
+                        help="Exit code 1 when median import plus create_app time exceeds this many seconds")
+    args = parser.parse_args()
+
+    issuer = FakeIssuer(CLIENT_ID, groups=SCOPE_GROUPS).start()
+    app = make_app(issuer, args.redis_url)
+    results = {
+        "meta": {
+            "revision": git_revision(),
+            "python": platform.python_version(),
+            "timestamp": int(time()),
+            "redis": "external" if args.redis_url else "fakeredis",
+        },
+        "scenarios": dict(),
+    }
+    for name, setup in build_scenarios(app, issuer, args.iterations).items():
+        if args.scenario and name not in args.scenario:
+            continue
+        results["scenarios"][name] = measure(setup(), args.iterations, args.warmup)
+        print(f"{name:28} {results['scenarios'][name]}", file=sys.stderr)
+    over_budget = False
+    if args.startup_runs > 0:
+        for name, result in measure_startup(args.startup_runs).items():
+            results["scenarios"][name] = result
+            print(f"{name:28} {result}", file=sys.stderr)
+        startup = sum(results["scenarios"][name]["p50_ms"] for name in ("startup_import", "startup_create_app"))
+        if args.startup_budget is not None and startup > args.startup_budget * 1000:
+            print(f"Startup {startup:.1f}ms is over {args.startup_budget * 1000:.0f}ms budget", file=sys.stderr)
+            over_budget = True
+    issuer.stop()
+
+    output = json.dumps(results, indent=2)
+    if args.output:
+        with open(args.output, "w") as file:
+            file.write(output)
+    else:
+        print(output)
+    if args.compare:
+        with open(args.compare) as file:
+            regressions = compare(results, json.load(file), args.tolerance)
+        if regressions:
+            print(f"Regressed: {', '.join(regressions)}", file=sys.stderr)
+            sys.exit(1)
+    if over_budget:
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,117 @@
+#   Copyright 2020 getcarrier.io
+#
+#   Licensed under the Apache License, Version 2.0 (the "License");
+#   you may not use this file except in compliance with the License.
+#   You may obtain a copy of the License at
+#
+#       http://www.apache.org/licenses/LICENSE-2.0
+#
+#   Unless required by applicable law or agreed to in writing, software
+#   distributed under the License is distributed on an "AS IS" BASIS,
+#   WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#   See the License for the specific language governing permissions and
+#   limitations under the License.
+
+""" Minimal local OIDC issuer: discovery, token, JWKS and logout endpoints """
+
+import json
+import threading
+from time import time
+from uuid import uuid4
+
+from Cryptodome.PublicKey import RSA
+from flask import Flask, jsonify, request
+from jwkest.jwk import RSAKey
+from jwkest.jws import JWS
+from werkzeug.serving import WSGIRequestHandler, make_server
+
+REALM_PATH = "/auth/realms/bench"
+
+
+class QuietRequestHandler(WSGIRequestHandler):
+    def log_request(self, *args, **kwargs):
+        pass
+
+
+class FakeIssuer:
+    def __init__(self, client_id, host="127.0.0.1", port=0, groups=None):
+        self.client_id = client_id
+        self.groups = groups or []
+        self.key = RSAKey(key=RSA.generate(2048), kid=uuid4().hex)
+        self.codes = dict()  # code -> nonce, filled by the benchmark before calling /callback
+        self.app = self._make_app()
+        self.server = make_server(host, port, self.app, threaded=True, request_handler=QuietRequestHandler)
+        self.issuer = f"http://{host}:{self.server.server_port}{REALM_PATH}"
+        self.thread = threading.Thread(target=self.server.serve_forever, daemon=True)
+
+    def start(self):
+        self.thread.start()
+        return self
+
+    def stop(self):
+        self.server.shutdown()
+
+    def sign(self, **claims):
+        return JWS(json.dumps(claims), alg="RS256").sign_compact([self.key])
+
+    def token(self, typ="Bearer", username="bench", ttl=300, **claims):
+        now = int(time())
+        payload = {
+            "iss": self.issuer, "aud": self.client_id, "azp": self.client_id, "sub": username,
+            "typ": typ, "iat": now, "exp": now + ttl, "jti": uuid4().hex,
+            "preferred_username": username, "name": username, "email": f"{username}@example.com",
+            "groups": self.groups,
+        }
+        payload.update(claims)
+        return self.sign(**payload)
+
+    def _make_app(self):
+        app = Flask(__name__)
+        realm = REALM_PATH
+
+        @app.route(f"{realm}/.well-known/openid-configuration")
+        def discovery():
+            return jsonify({
+                "issuer": self.issuer,
+                "authorization_endpoint": f"{self.issuer}/protocol/openid-connect/auth",
+                "token_endpoint": f"{self.issuer}/protocol/openid-connect/token",
+                "end_session_endpoint": f"{self.issuer}/protocol/openid-connect/logout",
+                "jwks_uri": f"{self.issuer}/protocol/openid-connect/certs",
+                "response_types_supported": ["code"],
+                "subject_types_supported": ["public"],
+                "id_token_signing_alg_values_supported": ["RS256"],
+            })
+
+        @app.route(f"{realm}/protocol/openid-connect/certs")
+        def certs():
+            return jsonify({"keys": [self.key.serialize(private=False)]})
+
+        @app.route(f"{realm}/protocol/openid-connect/token", methods=["POST"])
+        def token():
+            grant_type = request.form.get("grant_type")
+            claims = dict()
+            if grant_type == "password":
+                if request.form.get("password") != "password":
+                    return jsonify({"error": "invalid_grant"}), 401
+                claims["preferred_username"] = request.form.get("username")
+            elif grant_type == "authorization_code":
+                nonce = self.codes.pop(request.form.get("code"), None)
+                if nonce is None:
+                    return jsonify({"error": "invalid_grant"}), 400
+                claims["nonce"] = nonce
+            elif grant_type != "refresh_token":
+                return jsonify({"error": "unsupported_grant_type"}), 400
+            return jsonify({
+                "access_token": self.token(),
+                "token_type": "Bearer",
+                "expires_in": 300,
+                "refresh_token": self.token(typ="Refresh", ttl=1800),
+                "refresh_expires_in": 1800,
+                "id_token": self.token(typ="ID", **claims),
+            })
+
+        @app.route(f"{realm}/protocol/openid-connect/logout", methods=["GET", "POST"])
+        def logout():
+            return "", 204
+
+        return app
@@ -30,5 +30,5 @@ setup(
     zip_safe=False,
     include_package_data=True,
     install_requires=required_dependencies,
-    entry_points={"console_scripts": ["app = auth.app:main"]},
+    entry_points={"console_scripts": ["app = auth.app:main", "auth-maintenance = auth.maintenance:main"]},
 )
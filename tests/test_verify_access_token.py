@@ -0,0 +1,116 @@
+#   Copyright 2020 getcarrier.io
+#
+#   Licensed under the Apache License, Version 2.0 (the "License");
+#   you may not use this file except in compliance with the License.
+#   You may obtain a copy of the License at
+#
+#       http://www.apache.org/licenses/LICENSE-2.0
+#
+#   Unless required by applicable law or agreed to in writing, software
+#   distributed under the License is distributed on an "AS IS" BASIS,
+#   WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#   See the License for the specific language governing permissions and
+#   limitations under the License.
+
+""" Local access token verification against the JWKS of a fake issuer """
+
+from json import dumps
+from time import time
+from uuid import uuid4
+
+import pytest
+from Cryptodome.PublicKey import RSA
+from jwkest.jwk import RSAKey
+from jwkest.jws import JWS
+
+from benchmarks.bench_forward_auth import make_app
+from benchmarks.fake_issuer import FakeIssuer
+
+
+@pytest.fixture(scope="module")
+def issuer():
+    fake_issuer = FakeIssuer("bench").start()
+    yield fake_issuer
+    fake_issuer.stop()
+
+
+@pytest.fixture(scope="module")
+def verify(issuer):
+    app = make_app(issuer)
+    from auth.drivers.oidc import _verify_access_token
+
+    def _verify(token):
+        with app.app_context():
+            return _verify_access_token(token)
+    return _verify
+
+
+def claims(issuer, **overrides):
+    now = int(time())
+    payload = {
+        "iss": issuer.issuer, "aud": issuer.client_id, "azp": issuer.client_id, "sub": "bench",
+        "typ": "Bearer", "iat": now, "exp": now + 300, "preferred_username": "bench", "groups": ["/grafana"],
+    }
+    payload.update(overrides)
+    return {key: value for key, value in payload.items() if value is not None}
+
+
+def sign_with(key, payload):
+    return JWS(dumps(payload), alg="RS256").sign_compact([key])
+
+
+def test_valid_token(issuer, verify):
+    valid, auth_data = verify(issuer.sign(**claims(issuer)))
+    assert valid
+    assert auth_data["username"] == "bench"
+    assert auth_data["groups"] == ["/grafana"]
+
+
+def test_forged_signature_with_known_kid(issuer, verify):
+    forged = RSAKey(key=RSA.generate(2048), kid=issuer.key.kid)
+    assert verify(sign_with(forged, claims(issuer))) == (False, {})
+
+
+def test_unknown_kid(issuer, verify):
+    other = RSAKey(key=RSA.generate(2048), kid=uuid4().hex)
+    assert verify(sign_with(other, claims(issuer))) == (False, {})
+
+
+def test_expired(issuer, verify):
+    assert verify(issuer.sign(**claims(issuer, exp=int(time()) - 1))) == (False, {})
+
+
+def test_exp_not_a_number(issuer, verify):
+    assert verify(issuer.sign(**claims(issuer, exp="never"))) == (False, {})
+
+
+def test_wrong_issuer(issuer, verify):
+    assert verify(issuer.sign(**claims(issuer, iss="http://elsewhere/auth/realms/bench"))) == (False, {})
+
+
+def test_wrong_audience(issuer, verify):
+    assert verify(issuer.sign(**claims(issuer, aud="other", azp="other"))) == (False, {})
+
+
+def test_audience_without_azp(issuer, verify):
+    valid, _ = verify(issuer.sign(**claims(issuer, aud=["other", issuer.client_id], azp="other")))
+    assert valid
+
+
+def test_azp_without_audience(issuer, verify):
+    valid, _ = verify(issuer.sign(**claims(issuer, aud="account")))
+    assert valid
+
+
+def test_missing_preferred_username_falls_back_to_sub(issuer, verify):
+    valid, auth_data = verify(issuer.sign(**claims(issuer, preferred_username=None, sub="service-account")))
+    assert valid
+    assert auth_data["username"] == "service-account"
+
+
+def test_missing_username_and_sub(issuer, verify):
+    assert verify(issuer.sign(**claims(issuer, preferred_username=None, sub=None))) == (False, {})
+
+
+def test_malformed_header(verify):
+    assert verify("not-base64!.e30.c2ln") == (False, {})